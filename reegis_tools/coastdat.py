@@ -22,8 +22,12 @@ import requests
 import shutil
 import configparser
 import calendar
+import multiprocessing
+import multiprocessing.util
+import itertools
 
 # External libraries
+import numpy as np
 import pandas as pd
 import pvlib
 import shapely.wkt as wkt
@@ -48,6 +52,18 @@ except ImportError:
     db = None
     exc = None
 
+# Optional: streaming export from the database.
+try:
+    import sqlalchemy
+except ImportError:
+    sqlalchemy = None
+
+# Optional: shared memory for parallel processing (Python >= 3.8).
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
 
 def get_coastdat_data(year, filename):
     try:
@@ -103,8 +119,306 @@ def adapt_coastdat_weather_to_windpowerlib(w, data_height):
     return w
 
 
+class SharedWeather:
+    """Weather data of one coastdat year in shared memory blocks.
+
+    Each weather variable (e.g. v_wind, temp_air) is stored once as a
+    (gid x time) float64 array in a `multiprocessing.shared_memory` block.
+    Worker processes attach to the blocks using the picklable descriptor and
+    get zero-copy numpy views. The process that loaded the data owns the
+    blocks and removes them on `close()`.
+
+    Attributes
+    ----------
+    year : int
+    filename : str
+    index : pandas.DatetimeIndex
+        Time index of the weather data sets.
+    gids : list
+        Coastdat ids in the order of the rows of each array.
+    variables : list
+        Names of the weather variables.
+
+    Examples
+    --------
+    >>> with SharedWeather(2014).load() as shared:  # doctest: +SKIP
+    ...     desc = shared.descriptor()
+    ...     # In the worker:
+    ...     worker_weather = SharedWeather.attach(desc)
+    ...     temperature = worker_weather.array('temp_air')
+    """
+    def __init__(self, year=None, filename=None):
+        if shared_memory is None:
+            raise ImportError(
+                "Shared memory needs the multiprocessing.shared_memory "
+                "module (Python >= 3.8).")
+        if filename is None:
+            filename = os.path.join(
+                cfg.get('paths', 'coastdat'),
+                cfg.get('coastdat', 'file_pattern').format(year=year))
+        self.year = year
+        self.filename = filename
+        self.index = None
+        self.gids = None
+        self.rows = None
+        self.variables = None
+        self.blocks = {}
+        self.arrays = {}
+        self.owner = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def load(self):
+        """Read all weather data sets of the hdf5 file into shared memory."""
+        if not os.path.isfile(self.filename):
+            get_coastdat_data(self.year, self.filename)
+        weather = pd.HDFStore(self.filename, mode='r')
+        keys = weather.keys()
+        first = weather[keys[0]]
+        self.index = first.index
+        self.variables = list(first.columns)
+        self.gids = [int(k.replace('/', '')[1:]) for k in keys]
+        self.rows = {gid: n for n, gid in enumerate(self.gids)}
+        shape = (len(keys), len(self.index))
+        self.owner = True
+        try:
+            for var in self.variables:
+                self.blocks[var] = shared_memory.SharedMemory(
+                    create=True, size=int(np.prod(shape)) * 8)
+                self.arrays[var] = np.ndarray(shape, dtype=np.float64,
+                                              buffer=self.blocks[var].buf)
+            length = len(self.index)
+            for n, key in enumerate(keys):
+                local_weather = weather[key]
+                for var in self.variables:
+                    values = local_weather[var].values[:length]
+                    self.arrays[var][n, :len(values)] = values
+        except BaseException:
+            self.close()
+            raise
+        finally:
+            weather.close()
+        logging.info("Weather data of {0} loaded into shared memory.".format(
+            self.year))
+        return self
+
+    def descriptor(self):
+        """Picklable description to attach to the shared memory blocks."""
+        return {'year': self.year, 'filename': self.filename,
+                'index': self.index, 'gids': self.gids,
+                'blocks': {var: (self.blocks[var].name,
+                                 self.arrays[var].shape)
+                           for var in self.variables}}
+
+    @classmethod
+    def attach(cls, descriptor):
+        """Attach to shared memory blocks created by another process."""
+        shared = cls(year=descriptor['year'],
+                     filename=descriptor['filename'])
+        shared.index = descriptor['index']
+        shared.gids = descriptor['gids']
+        shared.rows = {gid: n for n, gid in enumerate(shared.gids)}
+        shared.variables = list(descriptor['blocks'].keys())
+        for var, (name, shape) in descriptor['blocks'].items():
+            shared.blocks[var] = shared_memory.SharedMemory(name=name)
+            shared.arrays[var] = np.ndarray(shape, dtype=np.float64,
+                                            buffer=shared.blocks[var].buf)
+        return shared
+
+    def array(self, variable):
+        """Zero-copy (gid x time) view of one weather variable."""
+        return self.arrays[variable]
+
+    def weather(self, gid):
+        """Weather data set of one coastdat id as pandas.DataFrame."""
+        n = self.rows[int(gid)]
+        return pd.DataFrame({var: self.arrays[var][n]
+                             for var in self.variables},
+                            index=self.index, columns=self.variables)
+
+    def average(self, variable, gids):
+        """Average time series of one variable over the given coastdat ids.
+        """
+        rows = [self.rows[int(gid)] for gid in gids]
+        return pd.Series(self.arrays[variable][rows].mean(axis=0),
+                         index=self.index)
+
+    def close(self):
+        """Release the shared memory. The owner also removes the blocks."""
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = {}
+
+
+def feedin_for_coastdat_point(local_weather, local_point, pv_sets, wind_sets,
+                              data_height):
+    """Calculate all given pv and wind sets for one coastdat weather set.
+
+    Parameters
+    ----------
+    local_weather : pandas.DataFrame
+        Coastdat2 weather data set of one location.
+    local_point : pandas.Series
+        Location of the weather data set with a 'lat' and a 'lon' value.
+    pv_sets : dict
+        Parameter sets can be created using `feedin.create_pvlib_sets()`.
+    wind_sets : dict
+        Parameter sets can be created using
+        `feedin.create_windpowerlib_sets()`.
+    data_height : dict
+        Height of each weather parameter.
+
+    Returns
+    -------
+    dict : A DataFrame for each (type, set_name) key.
+    """
+    results = {}
+    if len(pv_sets) > 0:
+        # Create a pvlib Location object
+        location = pvlib.location.Location(
+            latitude=local_point['lat'], longitude=local_point['lon'])
+
+        # Adapt weather data to the needs of the pvlib
+        local_weather_pv = adapt_coastdat_weather_to_pvlib(
+            local_weather, location)
+
+        # Create one DataFrame for each pv-set
+        for pv_key, pv_set in pv_sets.items():
+            results['solar', pv_key] = feedin.feedin_pv_sets(
+                local_weather_pv, location, pv_set)
+
+    # Create one DataFrame for each wind-set
+    if len(wind_sets) > 0:
+        local_weather_wind = adapt_coastdat_weather_to_windpowerlib(
+            local_weather, data_height)
+        for wind_key, wind_set in wind_sets.items():
+            results['wind', wind_key] = feedin.feedin_wind_sets(
+                local_weather_wind, wind_set)
+    return results
+
+
+# Data of the worker processes (see `init_feedin_worker()`).
+_worker = {}
+
+
+def init_feedin_worker(descriptor, pv_sets, wind_sets, data_height):
+    """Attach a worker process to the shared weather data. The blocks are
+    closed when the worker process exits."""
+    _worker['weather'] = SharedWeather.attach(descriptor)
+    _worker['sets'] = (pv_sets, wind_sets, data_height)
+    multiprocessing.util.Finalize(None, _worker['weather'].close,
+                                  exitpriority=10)
+
+
+def feedin_worker(task):
+    """Calculate the feed-in for one coastdat key in a worker process."""
+    coastdat_key, local_point = task
+    local_weather = _worker['weather'].weather(coastdat_key[2:])
+    return coastdat_key, feedin_for_coastdat_point(
+        local_weather, local_point, *_worker['sets'])
+
+
+def open_feedin_set_file(filename, fingerprints, overwrite=False):
+    """Open the file of a feed-in set and find the subsets that have to be
+    calculated.
+
+    The fingerprint of each subset is stored within the file (key:
+    'fingerprints'). Results of subsets with a known fingerprint are copied
+    from the existing file, so only new or changed subsets are calculated.
+
+    Parameters
+    ----------
+    filename : str
+        Full file name of the feed-in set file.
+    fingerprints : pandas.DataFrame
+        Column name and fingerprint of each subset. See
+        `feedin.pvlib_set_fingerprints()`.
+    overwrite : bool
+        Calculate all subsets even if a valid result exists.
+
+    Returns
+    -------
+    dict or None : None if the file is up to date. Otherwise a dictionary with
+        the opened files and the subsets to calculate.
+    """
+    stored = None
+    if os.path.isfile(filename) and not overwrite:
+        try:
+            stored = pd.read_hdf(filename, 'fingerprints', mode='r')
+        except KeyError:
+            logging.info("No fingerprints found in {0}.".format(filename))
+
+    new = pd.Series(fingerprints['fingerprint'].values,
+                    index=fingerprints['column'].values)
+    keep = {}
+    if stored is not None:
+        if stored.sort_index().equals(new.sort_index()):
+            logging.debug("Skipped: {0} is up to date.".format(filename))
+            return None
+        known = pd.Series(stored.index, index=stored.values)
+        known = known[~known.index.duplicated()]
+        keep = {known[fp]: col for col, fp in new.iteritems()
+                if fp in known.index}
+
+    subsets = [k for k in fingerprints.index
+               if fingerprints.loc[k, 'column'] not in keep.values()]
+    logging.info("{0}: {1} of {2} subsets will be calculated.".format(
+        os.path.basename(filename), len(subsets), len(fingerprints)))
+
+    if len(keep) > 0:
+        old = pd.HDFStore(filename, mode='r')
+        store = pd.HDFStore(filename + '.new', mode='w')
+    else:
+        old = None
+        store = pd.HDFStore(filename, mode='w')
+    store['fingerprints'] = new
+    return {'filename': filename, 'store': store, 'old': old, 'keep': keep,
+            'subsets': subsets, 'columns': list(new.index), 'closed': False}
+
+
+def write_feedin_set(feedin_set_file, coastdat_key, df=None):
+    """Write the calculated subsets and the copied subsets of one coastdat
+    key to the file of a feed-in set (see `open_feedin_set_file()`)."""
+    keep = feedin_set_file['keep']
+    if df is None:
+        df = pd.DataFrame()
+    if len(keep) > 0:
+        old_df = feedin_set_file['old'][coastdat_key][list(keep.keys())]
+        df = pd.concat([old_df.rename(columns=keep), df], axis=1)
+    feedin_set_file['store'][coastdat_key] = df[feedin_set_file['columns']]
+
+
+def close_feedin_set_file(feedin_set_file, complete=True):
+    """Close the file of a feed-in set (see `open_feedin_set_file()`).
+
+    If the file is not complete (e.g. after an error), the new file is
+    removed. An existing file is kept unchanged. Closed files are skipped.
+    """
+    if feedin_set_file['closed']:
+        return
+    feedin_set_file['closed'] = True
+    filename = feedin_set_file['filename']
+    feedin_set_file['store'].close()
+    if feedin_set_file['old'] is not None:
+        feedin_set_file['old'].close()
+        filename += '.new'
+        if complete:
+            os.replace(filename, feedin_set_file['filename'])
+    if not complete and os.path.isfile(filename):
+        os.remove(filename)
+        logging.warning("Incomplete feed-in set file {0} removed.".format(
+            filename))
+
+
 def normalised_feedin_for_each_data_set(year, wind=True, solar=True,
-                                        overwrite=False):
+                                        overwrite=False, processes=None):
     """
     Loop over all weather data sets (regions) and calculate a normalised time
     series for each data set with the given parameters of the power plants.
@@ -118,6 +432,13 @@ def normalised_feedin_for_each_data_set(year, wind=True, solar=True,
         Set to True if you want to create wind feed-in time series.
     solar : boolean
         Set to True if you want to create solar feed-in time series.
+    overwrite : boolean
+        Calculate all subsets again. By default (False) only subsets with new
+        or changed parameters are calculated (see `open_feedin_set_file()`).
+    processes : int
+        Number of worker processes. The weather data is loaded once into
+        shared memory (see `SharedWeather`). By default (None) all data sets
+        are calculated within the current process.
 
     Returns
     -------
@@ -174,8 +495,11 @@ def normalised_feedin_for_each_data_set(year, wind=True, solar=True,
         for pv_key, pv_set in pv_sets.items():
             filename = feedin_file.format(
                 type='solar', year=year, set_name=pv_key)
-            if not os.path.isfile(filename) or overwrite:
-                hdf['solar'][pv_key] = pd.HDFStore(filename, mode='w')
+            feedin_set_file = open_feedin_set_file(
+                filename, feedin.pvlib_set_fingerprints(pv_set, year),
+                overwrite)
+            if feedin_set_file is not None:
+                hdf['solar'][pv_key] = feedin_set_file
     else:
         pv_sets = {}
 
@@ -190,69 +514,85 @@ def normalised_feedin_for_each_data_set(year, wind=True, solar=True,
         for wind_key, wind_set in wind_sets.items():
             filename = feedin_file.format(
                 type='wind', year=year, set_name=wind_key)
-            if not os.path.isfile(filename) or overwrite:
-                hdf['wind'][wind_key] = pd.HDFStore(filename, mode='w')
+            feedin_set_file = open_feedin_set_file(
+                filename, feedin.windpowerlib_set_fingerprints(wind_set, year),
+                overwrite)
+            if feedin_set_file is not None:
+                hdf['wind'][wind_key] = feedin_set_file
     else:
         wind_sets = {}
 
+    # Only calculate the new or changed subsets of the sets with an open file.
+    # If no file is open, there is nothing to do.
+    pv_sets = {k: {s: v[s] for s in hdf['solar'][k]['subsets']}
+               for k, v in pv_sets.items() if k in hdf['solar']}
+    wind_sets = {k: {s: v[s] for s in hdf['wind'][k]['subsets']}
+                 for k, v in wind_sets.items() if k in hdf['wind']}
+    pv_sets = {k: v for k, v in pv_sets.items() if len(v) > 0}
+    wind_sets = {k: v for k, v in wind_sets.items() if len(v) > 0}
+
     # Define basic variables for time logging
     remain = len(coastdat_keys)
     done = 0
     start = datetime.datetime.now()
 
-    # Loop over all regions
-    for coastdat_key in coastdat_keys:
-        # Get weather data set for one location
-        local_weather = weather[coastdat_key]
-
-        # Adapt the coastdat weather format to the needs of pvlib.
-        # The expression "len(list(hdf['solar'].keys()))" returns the number
-        # of open hdf5 files. If no file is open, there is nothing to do.
-        if solar and len(list(hdf['solar'].keys())) > 0:
-            # Get coordinates for the weather location
-            local_point = data_points.loc[int(coastdat_key[2:])]
-
-            # Create a pvlib Location object
-            location = pvlib.location.Location(
-                latitude=local_point['lat'], longitude=local_point['lon'])
-
-            # Adapt weather data to the needs of the pvlib
-            local_weather_pv = adapt_coastdat_weather_to_pvlib(
-                local_weather, location)
-
-            # Create one DataFrame for each pv-set and store into the file
-            for pv_key, pv_set in pv_sets.items():
-                if pv_key in hdf['solar']:
-                    hdf['solar'][pv_key][coastdat_key] = feedin.feedin_pv_sets(
-                        local_weather_pv, location, pv_set)
-
-        # Create one DataFrame for each wind-set and store into the file
-        if wind and len(list(hdf['wind'].keys())) > 0:
-            local_weather_wind = adapt_coastdat_weather_to_windpowerlib(
-                local_weather, data_height)
-            for wind_key, wind_set in wind_sets.items():
-                if wind_key in hdf['wind']:
-                    hdf['wind'][wind_key][coastdat_key] = (
-                        feedin.feedin_wind_sets(
-                            local_weather_wind, wind_set))
-
-        # Start- time logging *******
-        remain -= 1
-        done += 1
-        if divmod(remain, 10)[1] == 0:
-            elapsed_time = (datetime.datetime.now() - start).seconds
-            remain_time = elapsed_time / done * remain
-            end_time = datetime.datetime.now() + datetime.timedelta(
-                seconds=remain_time)
-            msg = "Actual time: {:%H:%M}, estimated end time: {:%H:%M}, "
-            msg += "done: {0}, remain: {1}".format(done, remain)
-            logging.info(msg.format(datetime.datetime.now(), end_time))
-        # End - time logging ********
-
-    for k1 in hdf.keys():
-        for k2 in hdf[k1].keys():
-            hdf[k1][k2].close()
-    weather.close()
+    # Calculate the feed-in of each location within the current process or
+    # within worker processes that share the weather data.
+    tasks = ((k, data_points.loc[int(k[2:])]) for k in coastdat_keys)
+    shared = None
+    pool = None
+    try:
+        if processes is not None and processes > 1:
+            weather.close()
+            shared = SharedWeather(year, weather_file_name).load()
+            pool = multiprocessing.Pool(
+                processes, initializer=init_feedin_worker,
+                initargs=(shared.descriptor(), pv_sets, wind_sets,
+                          data_height))
+            results = pool.imap_unordered(feedin_worker, tasks)
+        else:
+            results = ((k, feedin_for_coastdat_point(
+                weather[k], p, pv_sets, wind_sets, data_height))
+                for k, p in tasks)
+
+        # Loop over all regions and store the results into the files
+        for coastdat_key, local_feedin in results:
+            for set_type in hdf.keys():
+                for set_key, feedin_set_file in hdf[set_type].items():
+                    write_feedin_set(feedin_set_file, coastdat_key,
+                                     local_feedin.get((set_type, set_key)))
+
+            # Start- time logging *******
+            remain -= 1
+            done += 1
+            if divmod(remain, 10)[1] == 0:
+                elapsed_time = (datetime.datetime.now() - start).seconds
+                remain_time = elapsed_time / done * remain
+                end_time = datetime.datetime.now() + datetime.timedelta(
+                    seconds=remain_time)
+                msg = "Actual time: {:%H:%M}, estimated end time: {:%H:%M}, "
+                msg += "done: {0}, remain: {1}".format(done, remain)
+                logging.info(msg.format(datetime.datetime.now(), end_time))
+            # End - time logging ********
+
+        for k1 in hdf.keys():
+            for k2 in hdf[k1].keys():
+                close_feedin_set_file(hdf[k1][k2])
+        if pool is not None:
+            pool.close()
+            pool.join()
+    finally:
+        # Stop the workers, remove the shared memory blocks and the
+        # incomplete feed-in set files even if a worker or the writing of the
+        # results failed.
+        if pool is not None:
+            pool.terminate()
+        if shared is not None:
+            shared.close()
+        weather.close()
+        for k1 in hdf.keys():
+            for k2 in hdf[k1].keys():
+                close_feedin_set_file(hdf[k1][k2], complete=False)
     logging.info("All feedin time series for {0} are stored in {1}".format(
         year, coastdat_path.format(year=year, type='')))
 
@@ -345,7 +685,46 @@ def get_average_wind_speed(weather_path, grid_geometry_file, geometry_path,
         logging.info("Skipped: Calculating the average wind speed.")
 
 
-def spatial_average_weather(year, geo, parameter, outpath=None, outfile=None):
+def average_weather_from_file(year, geo, parameter, coastdat_geo, col_name,
+                              fix):
+    """Calculate the average of a weather parameter for each region reading
+    the coastdat weather file (see `spatial_average_weather()`)."""
+    # Open the weather file
+    weatherfile = os.path.join(
+        cfg.get('paths', 'coastdat'),
+        cfg.get('coastdat', 'file_pattern').format(year=year))
+    if not os.path.isfile(weatherfile):
+        get_coastdat_data(year, weatherfile)
+    weather = pd.HDFStore(weatherfile, mode='r')
+
+    # Calculate the average temperature for each region with more than one id.
+    avg_value = pd.DataFrame()
+    for region in geo.gdf.index:
+        cd_ids = coastdat_geo.gdf[coastdat_geo.gdf[col_name] == region].index
+        number_of_sets = len(cd_ids)
+        tmp = pd.DataFrame()
+        logging.debug((region, len(cd_ids)))
+        for cid in cd_ids:
+            try:
+                cid = int(cid)
+            except ValueError:
+                pass
+            if isinstance(cid, int):
+                key = 'A' + str(cid)
+            else:
+                key = cid
+            tmp[cid] = weather[key][parameter]
+        if len(cd_ids) < 1:
+            key = 'A' + str(fix[region])
+            avg_value[region] = weather[key][parameter]
+        else:
+            avg_value[region] = tmp.sum(1).div(number_of_sets)
+    weather.close()
+    return avg_value
+
+
+def spatial_average_weather(year, geo, parameter, outpath=None, outfile=None,
+                            shared_weather=None):
     """
     Calculate the average temperature for all regions (de21, states...).
 
@@ -361,6 +740,9 @@ def spatial_average_weather(year, geo, parameter, outpath=None, outfile=None):
         Set your own name for the outputfile.
     parameter : str
         Name of the item (temperature, wind speed,... of the weather data set.
+    shared_weather : SharedWeather
+        Weather data in shared memory. If None (default) the weather file of
+        the given year is read.
 
     Returns
     -------
@@ -373,56 +755,33 @@ def spatial_average_weather(year, geo, parameter, outpath=None, outfile=None):
     col_name = geo.name.replace(' ', '_')
 
     # Create a Geometry object for the coastdat centroids.
-    coastdat_geo = geometries.Geometry(name='coastdat')
-    coastdat_geo.load(cfg.get('paths', 'geometry'),
-                      cfg.get('coastdat', 'coastdatgrid_polygon'))
+    coastdat_poly = geometries.registry.get('coastdat2')
+    coastdat_geo = coastdat_poly.copy(name='coastdat')
     coastdat_geo.gdf['geometry'] = coastdat_geo.gdf.centroid
 
-    # Join the tables to create a list of coastdat id's for each region.
-    coastdat_geo.gdf = geometries.spatial_join_with_buffer(
-        coastdat_geo, geo, limit=0)
+    # Get the region of each coastdat id from the mapping of the regions.
+    coastdat_geo.gdf[col_name] = geometries.region_mapping(geo).assign(
+        'coastdat2_centroid', coastdat_geo, limit=0)
 
     # Fix regions with no matches (this my happen if a region ist to small).
     fix = {}
     for reg in set(geo.gdf.index) - set(coastdat_geo.gdf[col_name].unique()):
         reg_point = geo.gdf.representative_point().loc[reg]
-        coastdat_poly = geometries.Geometry(name='coastdat_poly')
-        coastdat_poly.load(cfg.get('paths', 'geometry'),
-                           cfg.get('coastdat', 'coastdatgrid_polygon'))
         fix[reg] = coastdat_poly.gdf.loc[coastdat_poly.gdf.intersects(
             reg_point)].index[0]
 
-    # Open the weather file
-    weatherfile = os.path.join(
-        cfg.get('paths', 'coastdat'),
-        cfg.get('coastdat', 'file_pattern').format(year=year))
-    if not os.path.isfile(weatherfile):
-        get_coastdat_data(year, weatherfile)
-    weather = pd.HDFStore(weatherfile, mode='r')
-
-    # Calculate the average temperature for each region with more than one id.
-    avg_value = pd.DataFrame()
-    for region in geo.gdf.index:
-        cd_ids = coastdat_geo.gdf[coastdat_geo.gdf[col_name] == region].index
-        number_of_sets = len(cd_ids)
-        tmp = pd.DataFrame()
-        logging.debug((region, len(cd_ids)))
-        for cid in cd_ids:
-            try:
-                cid = int(cid)
-            except ValueError:
-                pass
-            if isinstance(cid, int):
-                key = 'A' + str(cid)
-            else:
-                key = cid
-            tmp[cid] = weather[key][parameter]
-        if len(cd_ids) < 1:
-            key = 'A' + str(fix[region])
-            avg_value[region] = weather[key][parameter]
-        else:
-            avg_value[region] = tmp.sum(1).div(number_of_sets)
-    weather.close()
+    # Use the weather data from shared memory if present.
+    if shared_weather is not None:
+        avg_value = pd.DataFrame()
+        for region in geo.gdf.index:
+            cd_ids = coastdat_geo.gdf[
+                coastdat_geo.gdf[col_name] == region].index
+            if len(cd_ids) < 1:
+                cd_ids = [fix[region]]
+            avg_value[region] = shared_weather.average(parameter, cd_ids)
+    else:
+        avg_value = average_weather_from_file(year, geo, parameter,
+                                              coastdat_geo, col_name, fix)
 
     # Create the name an write to file
     regions = sorted(geo.gdf.index)
@@ -439,9 +798,7 @@ def spatial_average_weather(year, geo, parameter, outpath=None, outfile=None):
 
 
 def federal_state_average_weather(year, parameter):
-    federal_states = geometries.Geometry(name='federal_states')
-    federal_states.load(cfg.get('paths', 'geometry'),
-                        cfg.get('geometry', 'federalstates_polygon'))
+    federal_states = geometries.registry.get('federal_states')
     filename = os.path.join(
         cfg.get('paths', 'coastdat'),
         'average_{0}_BB_TH_{1}.csv'.format(parameter, year))
@@ -505,6 +862,181 @@ def fetch_coastdat2_year_from_db(years=None, overwrite=False):
             logging.info("Weather data for {0} exists. Skipping.".format(year))
 
 
+# Query to fetch all weather data sets of one year within a polygon from the
+# coastdat schema of the RLI-database. The result has to be ordered by the gid
+# and must contain the columns gid, name (of the variable) and tsarray.
+COASTDAT_DB_SQL = """
+    SELECT sp.gid, dt.name, ts.tsarray
+    FROM coastdat.cosmoclmgrid AS sp
+    INNER JOIN coastdat.located AS l ON (sp.gid = l.spatial_id)
+    INNER JOIN coastdat.timeseries AS ts ON (l.data_id = ts.id)
+    INNER JOIN coastdat.typified AS typ ON (ts.id = typ.data_id)
+    INNER JOIN coastdat.datatype AS dt ON (typ.type_id = dt.id)
+    INNER JOIN coastdat.scheduled AS sc ON (ts.id = sc.data_id)
+    WHERE sc.time_id = :year
+    AND ST_Intersects(sp.geom, ST_GeomFromText(:polygon, 4326))
+    ORDER BY sp.gid, dt.name;
+    """
+
+# Database engines of the current process (see `get_db_engine()`).
+_engines = {}
+
+
+def get_db_engine(url=None):
+    """Get a pooled database engine. One engine is created per url and
+    process. By default the url is created from the [postGIS] section of the
+    config file."""
+    if sqlalchemy is None:
+        raise ImportError("The sqlalchemy package is needed to connect to "
+                          "the database.")
+    if url is None:
+        url = 'postgresql://{username}@{host}:{port}/{database}'.format(
+            **cfg.get_dict('postGIS'))
+    if url not in _engines:
+        _engines[url] = sqlalchemy.create_engine(url)
+    return _engines[url]
+
+
+def dispose_db_engine(engine):
+    """Close all pooled connections of an engine (see `get_db_engine()`) and
+    remove it from the engines of the process."""
+    engine.dispose()
+    for url in [u for u, e in _engines.items() if e is engine]:
+        del _engines[url]
+
+
+def weather_array(value):
+    """Convert a database array (list or postgres array string) to a numpy
+    array."""
+    if isinstance(value, str):
+        value = [v for v in value.strip('{}[]').split(',') if v.strip()]
+    return np.asarray(value, dtype=np.float64)
+
+
+def export_coastdat2_year(year, url=None, polygon=None, sql=None,
+                          overwrite=False, hdf_format='table'):
+    """Stream all coastdat2 weather data sets of one year from the database
+    into a hdf5 file.
+
+    A server-side cursor is used and each data set is written as soon as all
+    rows of its gid have arrived, so only one data set is kept in memory.
+    The file is written to a temporary file and renamed if the export is
+    complete.
+
+    Parameters
+    ----------
+    year : int
+        Year to fetch.
+    url : str
+        Database url (sqlalchemy). See `get_db_engine()`.
+    polygon : shapely.geometry.Polygon
+        Only data sets within this polygon are fetched. By default the polygon
+        of Germany is used.
+    sql : str
+        Query to fetch the data. See `COASTDAT_DB_SQL`.
+    overwrite : bool
+        Skip existing files if set to False.
+    hdf_format : str
+        Format of the hdf5 tables ('table' or 'fixed').
+
+    Returns
+    -------
+    int : Number of stored data sets.
+    """
+    filename = os.path.join(
+        cfg.get('paths', 'coastdat'),
+        cfg.get('coastdat', 'file_pattern').format(year=year))
+    if os.path.isfile(filename) and not overwrite:
+        logging.info("Weather data for {0} exists. Skipping.".format(year))
+        return 0
+
+    if sql is None:
+        sql = COASTDAT_DB_SQL
+    if polygon is None:
+        geometry = os.path.join(cfg.get('paths', 'geometry'),
+                                cfg.get('geometry', 'germany_polygon'))
+        polygon = wkt.loads(
+            pd.read_csv(geometry, index_col='gid', squeeze=True)[0])
+
+    rename = cfg.get_dict('coastdat_db_names')
+    index = None
+    number = 0
+    tmp_file = filename + '.tmp'
+    engine = get_db_engine(url)
+    conn = None
+    store = pd.HDFStore(tmp_file, mode='w')
+    complete = False
+
+    logging.info("Fetching weather data for {0}.".format(year))
+    try:
+        conn = engine.connect()
+        rows = conn.execution_options(stream_results=True).execute(
+            sqlalchemy.text(sql), {'year': year, 'polygon': polygon.wkt})
+
+        for gid, gid_rows in itertools.groupby(rows, key=lambda r: r[0]):
+            weather_set = pd.DataFrame()
+            for row in gid_rows:
+                values = weather_array(row[2])
+                if index is None or len(index) != len(values):
+                    index = pd.date_range(
+                        '{0}-01-01 00:00'.format(year), periods=len(values),
+                        freq='H', tz='UTC')
+                weather_set[rename.get(row[1], row[1])] = pd.Series(
+                    values, index=index)
+            store.put('A{0}'.format(int(gid)), weather_set,
+                      format=hdf_format)
+            number += 1
+            if number % 100 == 0:
+                logging.info("{0}: {1} data sets stored.".format(
+                    year, number))
+        complete = True
+    finally:
+        if conn is not None:
+            conn.close()
+        store.close()
+        if not complete:
+            # Remove the incomplete file and the engine, whose pooled
+            # connections might be broken.
+            dispose_db_engine(engine)
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+    if number > 0:
+        os.replace(tmp_file, filename)
+        logging.info("Success. Stored {0} data sets to {1}.".format(
+            number, filename))
+    else:
+        os.remove(tmp_file)
+        logging.warning("No weather data found for {0}.".format(year))
+    return number
+
+
+def export_coastdat2_years(years=None, processes=2, **kwargs):
+    """Export several years concurrently (see `export_coastdat2_year()`).
+    Each process uses its own pooled database connection.
+
+    Parameters
+    ----------
+    years : list of integer
+        Years to fetch.
+    processes : int
+        Number of years exported at the same time.
+
+    Returns
+    -------
+    dict : Number of stored data sets for each year.
+    """
+    if years is None:
+        years = range(1980, 2020)
+    pool = multiprocessing.Pool(processes)
+    jobs = {year: pool.apply_async(export_coastdat2_year, (year,), kwargs)
+            for year in years}
+    pool.close()
+    numbers = {year: job.get() for year, job in jobs.items()}
+    pool.join()
+    return numbers
+
+
 def coastdat_id2coord_from_db():
     """
     Creating a file with the latitude and longitude for all coastdat2 data
@@ -519,7 +1051,120 @@ def coastdat_id2coord_from_db():
     data.to_csv(os.path.join('data', 'basic', 'id2latlon.csv'))
 
 
-def aggregate_by_region_coastdat_feedin(pp, regions, year, category, outfile):
+def get_feedin_weights(pp, regions, year, category):
+    """Get the normalised capacity weights of each coastdat id within each
+    region.
+
+    Parameters
+    ----------
+    pp : pandas.DataFrame
+        Power plant table with a (category, region, coastdat_id) MultiIndex
+        and a 'capacity_<year>' column. The region column can be added with
+        `powerplants.add_model_regions()`.
+    regions : iterable
+        Names of the aggregation regions.
+    year : int
+    category : str
+
+    Returns
+    -------
+    pandas.Series : Weights with a (category, region, coastdat_id) MultiIndex.
+    """
+    cap_col = 'capacity_{0}'.format(year)
+    try:
+        capacity = pp.loc[category, cap_col].astype(float)
+    except KeyError:
+        capacity = pd.Series(index=pd.MultiIndex.from_arrays([[], []]),
+                             dtype=float)
+    capacity = capacity.loc[capacity.index.get_level_values(0).isin(regions)]
+    weights = capacity.div(capacity.groupby(level=0).transform('sum'))
+    weights.index = pd.MultiIndex.from_arrays(
+        [[category] * len(capacity),
+         capacity.index.get_level_values(0),
+         capacity.index.get_level_values(1).astype(int)],
+        names=['category', 'region', 'coastdat_id'])
+    weights.name = 'weight'
+    return weights
+
+
+def find_changed_regions(old_weights, new_weights, regions):
+    """Compare two weight tables (see `get_feedin_weights()`) and return all
+    regions whose weights differ.
+    """
+    changed = []
+    for region in regions:
+        try:
+            old = old_weights.xs(region, level='region').sort_index()
+        except KeyError:
+            old = pd.Series(dtype=float)
+        try:
+            new = new_weights.xs(region, level='region').sort_index()
+        except KeyError:
+            new = pd.Series(dtype=float)
+        if (len(old) != len(new) or not old.index.equals(new.index) or
+                not np.allclose(old.values, new.values)):
+            changed.append(region)
+    return changed
+
+
+def feedin_set_sources(pwr, columns):
+    """The fingerprint of each subset of the feed-in set files with the
+    (set, subset) column names of the aggregated table. The modification time
+    of the file is used for files without fingerprints.
+
+    Parameters
+    ----------
+    pwr : dict
+        Open HDFStore of each feed-in set.
+    columns : dict
+        Column names of each feed-in set.
+
+    Returns
+    -------
+    pandas.Series
+    """
+    sources = {}
+    for name, store in pwr.items():
+        try:
+            fingerprints = store['fingerprints']
+        except KeyError:
+            fingerprints = pd.Series(dtype=object)
+        mtime = repr(os.path.getmtime(store.filename))
+        for col in columns[name]:
+            sources[(name, '_'.join(col.split('_')[-3:]))] = str(
+                fingerprints.get(col, mtime))
+    sources = pd.Series(sources, name='source').sort_index()
+    sources.index.names = ['set', 'subset']
+    return sources
+
+
+def aggregate_by_region_coastdat_feedin(pp, regions, year, category, outfile,
+                                        incremental=True):
+    """Aggregate the normalised coastdat feed-in time series of all sets
+    within each region, weighted by the installed capacity of each coastdat
+    id.
+
+    The weights and the fingerprints of the feed-in sets are stored next to
+    the outfile ('<outfile>_weights.csv', '<outfile>_sources.csv'). If
+    incremental is True, all files exist and the feed-in sets are unchanged,
+    only regions whose weights have changed are re-aggregated and the stored
+    time series are patched.
+
+    Parameters
+    ----------
+    pp : pandas.DataFrame
+        Power plant table with a (category, region, coastdat_id) MultiIndex
+        and a 'capacity_<year>' column. For federal states it can be read
+        from the capacity cube (see `powerplants.get_capacity_cube()`).
+    regions : iterable
+        Names of the aggregation regions.
+    year : int
+    category : str
+    outfile : str
+        Full file name of the resulting csv-file.
+    incremental : bool
+        Re-use unchanged regions from an existing outfile.
+    """
     cat = category.lower()
 
     logging.info("Aggregating {0} feed-in for {1}...".format(cat, year))
@@ -539,19 +1184,47 @@ def aggregate_by_region_coastdat_feedin(pp, regions, year, category, outfile):
         if file[-2:] == 'h5':
             set_name = file[:-3].replace(replace_str, '')
             set_names.append(set_name)
-            pwr[set_name] = pd.HDFStore(os.path.join(coastdat_path, file))
+            pwr[set_name] = pd.HDFStore(os.path.join(coastdat_path, file),
+                                        mode='r')
             columns[set_name] = pwr[set_name]['/A1129087'].columns
 
     # Create DataFrame with MultiColumns to take the results
     my_index = pwr[set_name]['/A1129087'].index
-    my_cols = pd.MultiIndex(levels=[[], [], []], labels=[[], [], []],
+    my_cols = pd.MultiIndex(levels=[[], [], []], codes=[[], [], []],
                             names=[u'region', u'set', u'subset'])
     feed_in = pd.DataFrame(index=my_index, columns=my_cols)
 
+    # Get the weights of the coastdat ids and compare them with the weights
+    # of the last run to find the regions that have to be aggregated again.
+    weights_file = os.path.splitext(outfile)[0] + '_weights.csv'
+    sources_file = os.path.splitext(outfile)[0] + '_sources.csv'
+    weights = get_feedin_weights(pp, regions, year, category)
+    sources = feedin_set_sources(pwr, columns)
+    update_regions = list(regions)
+    if incremental and all(os.path.isfile(f) for f in [
+            outfile, weights_file, sources_file]):
+        old_feed_in = pd.read_csv(outfile, index_col=[0], header=[0, 1, 2])
+        old_weights = pd.read_csv(weights_file,
+                                  index_col=[0, 1, 2]).squeeze('columns')
+        old_sources = pd.read_csv(sources_file, index_col=[0, 1], dtype=str
+                                  ).squeeze('columns').sort_index()
+        if len(old_feed_in) == len(my_index) and old_sources.equals(sources):
+            update_regions = find_changed_regions(old_weights, weights,
+                                                  regions)
+            old_feed_in.index = my_index
+            keep = [c for c in old_feed_in.columns
+                    if c[0] in set(regions) - set(update_regions)]
+            feed_in = old_feed_in[keep].copy()
+            feed_in.columns.names = my_cols.names
+            logging.info("Re-aggregating {0} of {1} regions.".format(
+                len(update_regions), len(regions)))
+        else:
+            logging.info("Feed-in sets changed. Re-aggregating all regions.")
+
     # Loop over all aggregation regions
     # Sum up time series for one region and divide it by the
     # capacity of the region to get a normalised time series.
-    for region in regions:
+    for region in update_regions:
         try:
             coastdat_ids = pp.loc[(category, region)].index
         except KeyError:
@@ -585,11 +1258,135 @@ def aggregate_by_region_coastdat_feedin(pp, regions, year, category, outfile):
                             pp.loc[(category, region), 'capacity_{0}'.format(
                                 year)].sum())))
 
+    # Keep the order of the given regions.
+    feed_in = feed_in[[c for r in regions for c in feed_in.columns
+                       if c[0] == r]]
+
     feed_in.to_csv(outfile)
+    weights.to_csv(weights_file, header=True)
+    sources.to_csv(sources_file, header=True)
     for name_of_set in set_names:
         pwr[name_of_set].close()
 
 
+def feedin_by_plant(pp, year, category, set_name, subset=None, outfile=None,
+                    max_memory=500):
+    """Create hourly feed-in time series for each single power plant.
+
+    Each plant is linked to exactly one coastdat weather set, so the plant
+    time series are the product of the sparse (plant x coastdat id) capacity
+    matrix with the normalised feed-in of the coastdat ids. The normalised
+    time series are loaded once and the plants are processed in chunks. Each
+    chunk is written to the outfile (key: 'chunk_<number>') and a table
+    ('plants') links every plant to its chunk.
+
+    Parameters
+    ----------
+    pp : pandas.DataFrame
+        Power plant table (see `powerplants.get_pp_by_year()`) with a
+        'capacity_<year>' and a 'coastdat2' column.
+    year : int
+    category : str
+        Energy source (energy_source_level_2), e.g. 'Wind', 'Solar'.
+    set_name : str
+        Name of the feed-in set (see the feedin file pattern).
+    subset : str
+        Column of the feed-in set. Can be omitted if the set has only one
+        subset.
+    outfile : str
+        Full file name of the resulting hdf5 file.
+    max_memory : float
+        Maximal size of one chunk of plant time series in MB.
+
+    Returns
+    -------
+    str : Full file name of the created file.
+    """
+    cat = category.lower()
+    cap_col = 'capacity_{0}'.format(year)
+    filename = os.path.join(
+        cfg.get('paths_pattern', 'coastdat'),
+        cfg.get('feedin', 'file_pattern')).format(
+            year=year, type=cat, set_name=set_name)
+    if outfile is None:
+        outfile = os.path.join(
+            cfg.get('paths_pattern', 'coastdat').format(year=year, type=cat),
+            'plant_feedin_{0}_{1}_{2}.h5'.format(year, cat, set_name))
+
+    plants = pp.loc[(pp['energy_source_level_2'] == category) &
+                    (pp[cap_col] > 0), [cap_col, 'coastdat2']].copy()
+    plants['coastdat2'] = pd.to_numeric(plants['coastdat2'], errors='coerce')
+
+    # Load the normalised feed-in of all needed coastdat ids as one
+    # (time x coastdat id) array.
+    pwr = pd.HDFStore(filename, mode='r')
+    keys = set(pwr.keys())
+    gids = [int(g) for g in plants['coastdat2'].dropna().unique()
+            if '/A{0}'.format(int(g)) in keys]
+    missing = plants.loc[~plants['coastdat2'].isin(gids)]
+    if len(missing) > 0:
+        msg = "{0} plants ({1} MW) without feed-in set are skipped."
+        logging.warning(msg.format(len(missing),
+                                   round(missing[cap_col].sum())))
+        plants = plants.loc[plants['coastdat2'].isin(gids)]
+    normalised = None
+    index = None
+    for n, gid in enumerate(gids):
+        df = pwr['/A{0}'.format(gid)]
+        if subset is None:
+            subset = df.columns[0]
+        if normalised is None:
+            index = df.index
+            normalised = np.zeros((len(index), len(gids)), dtype=np.float32)
+        normalised[:, n] = df[subset].values[:len(index)]
+    pwr.close()
+
+    if normalised is None:
+        logging.warning("No plants found for {0} in {1}.".format(
+            category, year))
+        return None
+
+    # Position of the coastdat id of each plant in the normalised array.
+    position = pd.Series(np.arange(len(gids)), index=gids)
+    plant_pos = position.loc[plants['coastdat2'].astype(int)].values
+    capacity = plants[cap_col].values.astype(np.float32)
+
+    # Number of plants per chunk within the given memory limit.
+    chunksize = max(int(max_memory * 1e6 / (len(index) * 4)), 1)
+    store = pd.HDFStore(outfile, mode='w')
+    chunk_table = pd.Series(0, index=plants.index, name='chunk')
+    for n, first in enumerate(range(0, len(plants), chunksize)):
+        last = first + chunksize
+        key = 'chunk_{0}'.format(n)
+        store[key] = pd.DataFrame(
+            normalised[:, plant_pos[first:last]] * capacity[first:last],
+            index=index, columns=plants.index[first:last])
+        chunk_table.iloc[first:last] = n
+        logging.debug("Chunk {0} stored ({1} plants).".format(
+            n, len(plants.index[first:last])))
+    store['plants'] = chunk_table
+    store.close()
+    logging.info("Feed-in of {0} plants stored to {1}".format(
+        len(plants), outfile))
+    return outfile
+
+
+def get_feedin_by_plant(filename, plant_ids=None):
+    """Read the feed-in time series of the given plants from a file created
+    with `feedin_by_plant()`. Only the chunks containing the plants are
+    read."""
+    store = pd.HDFStore(filename, mode='r')
+    chunk_table = store['plants']
+    if plant_ids is not None:
+        chunk_table = chunk_table.loc[plant_ids]
+    feed_in = []
+    for chunk in chunk_table.unique():
+        columns = chunk_table.loc[chunk_table == chunk].index
+        feed_in.append(store['chunk_{0}'.format(int(chunk))][columns])
+    store.close()
+    return pd.concat(feed_in, axis=1)
+
+
 def aggregate_by_region_hydro(pp, regions, year, outfile_name):
     hydro = reegis_tools.bmwi.bmwi_re_energy_capacity()['water']
 
@@ -27,6 +27,8 @@ __license__ = "GPLv3"
 
 # Python libraries
 import logging
+import hashlib
+import json
 
 # External libraries
 import pandas as pd
@@ -104,6 +106,55 @@ def create_pvlib_sets():
     return pvsets
 
 
+def fingerprint(parameter, year=None):
+    """Create a fingerprint of a parameter set and a weather year. The same
+    parameters will always result in the same fingerprint.
+
+    Parameters
+    ----------
+    parameter : dict
+        Parameter set. Values may be nested dictionaries or pandas.Series.
+    year : int
+        Year of the weather data set.
+
+    Returns
+    -------
+    str : Hexadecimal sha1 hash.
+    """
+    def normalise(value):
+        if isinstance(value, (dict, pd.Series)):
+            return {str(k): normalise(v) for k, v in value.items()}
+        if hasattr(value, 'item'):
+            return value.item()
+        return value
+
+    text = json.dumps({'parameter': normalise(parameter), 'year': year},
+                      sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def pvlib_set_fingerprints(pv_parameter_set, year=None):
+    """Get the column name and the fingerprint of each subset of a pv set.
+
+    Parameters
+    ----------
+    pv_parameter_set : dict
+        Parameter sets can be created using `create_pvlib_sets()`.
+    year : int
+        Year of the weather data set.
+
+    Returns
+    -------
+    pandas.DataFrame : Column name and fingerprint for each subset key.
+    """
+    fingerprints = pd.DataFrame(columns=['column', 'fingerprint'])
+    for key, pv_system in pv_parameter_set.items():
+        parameter = {k: v for k, v in pv_system.items() if k != 'name'}
+        fingerprints.loc[key] = (pv_system['name'],
+                                 fingerprint(parameter, year))
+    return fingerprints
+
+
 def feedin_pv_sets(weather, location, pv_parameter_set):
     """Create a pv feed-in time series from a given weather data set and a
     set of pvlib parameter sets. The result of every parameter set will be a
@@ -208,6 +259,30 @@ def create_windpowerlib_sets():
     return windsets
 
 
+def windpowerlib_set_fingerprints(wind_parameter_set, year=None):
+    """Get the column name and the fingerprint of each subset of a wind set.
+    The fingerprint contains the modelchain parameters of the windpowerlib.
+
+    Parameters
+    ----------
+    wind_parameter_set : dict
+        Parameter sets can be created using `create_windpowerlib_sets()`.
+    year : int
+        Year of the weather data set.
+
+    Returns
+    -------
+    pandas.DataFrame : Column name and fingerprint for each subset key.
+    """
+    modelchain_data = cfg.get_dict('windpowerlib')
+    fingerprints = pd.DataFrame(columns=['column', 'fingerprint'])
+    for key, turbine in wind_parameter_set.items():
+        parameter = {'turbine': turbine, 'modelchain': modelchain_data}
+        fingerprints.loc[key] = (turbine['turbine_name'].replace(' ', '_'),
+                                 fingerprint(parameter, year))
+    return fingerprints
+
+
 def feedin_wind_sets(weather, wind_parameter_set):
     """Create a pv feed-in time series from a given weather data set and a
     set of pvlib parameter sets. The result of every parameter set will be a
@@ -13,12 +13,150 @@ __license__ = "GPLv3"
 # Python libraries
 import os
 import logging
+import hashlib
+import pickle
+import zipfile
+import multiprocessing
+from collections import OrderedDict
 
 # External libraries
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 from shapely.wkt import loads as wkt_loads
+from shapely.wkb import loads as wkb_loads
 from shapely.geometry import Point
+from shapely.prepared import prep
+
+# Vectorised geometry functions (shapely >= 2.0). Older versions will use the
+# slower loops.
+try:
+    from shapely import points as shapely_points
+    from shapely import from_wkt, from_wkb, to_wkb, to_wkt, contains_xy
+    from shapely import get_x, get_y
+except ImportError:
+    shapely_points = None
+    get_x = None
+    get_y = None
+    from_wkt = None
+    from_wkb = None
+    to_wkb = None
+    to_wkt = None
+    contains_xy = None
+
+# Internal modules
+import reegis_tools.config as cfg
+
+
+def points_from_lon_lat(lon, lat):
+    """Create shapely points from arrays of longitudes and latitudes.
+
+    Parameters
+    ----------
+    lon : iterable
+    lat : iterable
+
+    Returns
+    -------
+    numpy.ndarray : Array of shapely points.
+    """
+    if shapely_points is not None:
+        return shapely_points(np.asarray(lon, dtype=np.float64),
+                              np.asarray(lat, dtype=np.float64))
+    return object_array([Point(x, y) for x, y in zip(lon, lat)])
+
+
+def lon_lat_from_points(points):
+    """Longitudes and latitudes of an iterable of shapely points.
+
+    Returns
+    -------
+    tuple : Two float arrays (lon, lat).
+    """
+    points = object_array(points)
+    if get_x is not None:
+        return get_x(points), get_y(points)
+    return (np.array([p.x for p in points], dtype=np.float64),
+            np.array([p.y for p in points], dtype=np.float64))
+
+
+def geometries_from_wkt(values):
+    """Create shapely geometries from an iterable of WKT strings."""
+    if from_wkt is not None:
+        return from_wkt(np.asarray(values, dtype=object))
+    return object_array([wkt_loads(v) for v in values])
+
+
+def geometries_from_wkb(values):
+    """Create shapely geometries from an iterable of WKB bytes or hex
+    strings."""
+    if from_wkb is not None:
+        return from_wkb(np.asarray(values, dtype=object))
+    return object_array([wkb_loads(v, hex=isinstance(v, str))
+                         for v in values])
+
+
+def geometries_to_wkb(geometries, hex=False):
+    """Convert an iterable of shapely geometries to WKB bytes (or hex
+    strings)."""
+    if to_wkb is not None:
+        return to_wkb(object_array(geometries), hex=hex)
+    if hex:
+        return object_array([g.wkb_hex for g in geometries])
+    return object_array([g.wkb for g in geometries])
+
+
+def geometries_to_wkt(geometries):
+    """Convert an iterable of shapely geometries to WKT strings."""
+    if to_wkt is not None:
+        return to_wkt(object_array(geometries), rounding_precision=-1)
+    return object_array([g.wkt for g in geometries])
+
+
+def object_array(values):
+    """Create a one-dimensional object array without unpacking the items."""
+    values = list(values)
+    array = np.empty(len(values), dtype=object)
+    for n, value in enumerate(values):
+        array[n] = value
+    return array
+
+
+def geometry_cache_file(fullname, extension='pkl'):
+    """Name of the binary cache file of a geometry csv-file."""
+    key = hashlib.sha1(os.path.abspath(fullname).encode('utf-8')).hexdigest()
+    name = os.path.basename(fullname)[:-4]
+    return os.path.join(cfg.get('paths', 'geometry_cache'),
+                        '{0}_{1}.{2}'.format(name, key[:12], extension))
+
+
+def write_file_atomic(filename, write):
+    """Write a file with the function write(file_object) to a temporary file
+    and move it to the filename, so other processes never read a half
+    written file."""
+    tmp_file = '{0}.{1}.tmp'.format(filename, os.getpid())
+    try:
+        with open(tmp_file, 'wb') as f:
+            write(f)
+        os.replace(tmp_file, filename)
+    finally:
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+
+def write_pickle(obj, filename):
+    """Pickle an object to a file (see `write_file_atomic()`)."""
+    write_file_atomic(
+        filename, lambda f: pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL))
+
+
+def points_in_polygon(polygon, x, y):
+    """Test which points (x, y) are within the polygon."""
+    if contains_xy is not None:
+        return contains_xy(polygon, x, y)
+    polygon = prep(polygon)
+    return np.array([polygon.contains(Point(a, b)) for a, b in zip(
+        np.ravel(x), np.ravel(y))], dtype=bool).reshape(np.shape(x))
 
 
 class Geometry:
@@ -30,6 +168,8 @@ class Geometry:
     df = pandas.DataFrame
     gdf = geopandas.GeoDataFrame
     invalid = pandas.Dataframe
+    simplified = pandas.DataFrame
+        Simplified polygons (see `prepare()`).
     lon_column : str
     lat_column :str
 
@@ -39,14 +179,30 @@ class Geometry:
         self.df = df
         self.gdf = None
         self.invalid = None
+        self.simplified = None
         self.lon_column = 'lon'
         self.lat_column = 'lat'
 
-    def load(self, path=None, filename=None, fullname=None, hdf_key=None):
-        """Load csv-file into a DataFrame and a GeoDataFrame."""
+    def load(self, path=None, filename=None, fullname=None, hdf_key=None,
+             cache=True):
+        """Load csv-file into a DataFrame and a GeoDataFrame.
+
+        The geometries of csv-files are cached in a binary (WKB) file, that
+        is used as long as the csv-file is not changed. Set cache=False to
+        always parse the csv-file.
+        """
         if fullname is None:
             fullname = os.path.join(path, filename)
 
+        if fullname[-4:] == '.csv' and cache:
+            if not self.load_cache(fullname):
+                self.load_csv(fullname=fullname)
+                self.create_geo_df()
+                self.write_cache(fullname)
+            else:
+                self.create_geo_df()
+            return self
+
         if fullname[-4:] == '.csv':
             self.load_csv(fullname=fullname)
 
@@ -83,6 +239,38 @@ class Geometry:
         if not any(self.df[first_col].duplicated()):
             self.df.set_index(first_col, drop=True, inplace=True)
 
+    def load_cache(self, fullname):
+        """Load the DataFrame from the binary cache of a csv-file. Returns
+        False if no valid cache exists."""
+        cache_file = geometry_cache_file(fullname)
+        if not os.path.isfile(cache_file):
+            return False
+        try:
+            cache = pd.read_pickle(cache_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            logging.warning("Cannot read cache file {0}.".format(cache_file))
+            return False
+        stat = os.stat(fullname)
+        if (cache['source'] != os.path.abspath(fullname) or
+                cache['mtime'] != stat.st_mtime or
+                cache['size'] != stat.st_size):
+            logging.debug("Cache of {0} is outdated.".format(fullname))
+            return False
+        self.df = cache['df']
+        self.df['geometry'] = geometries_from_wkb(self.df['geometry'])
+        logging.debug("Geometries loaded from cache {0}".format(cache_file))
+        return True
+
+    def write_cache(self, fullname):
+        """Write the GeoDataFrame of a csv-file into a binary cache file
+        (geometries as WKB)."""
+        stat = os.stat(fullname)
+        df = pd.DataFrame(self.gdf).copy()
+        df['geometry'] = geometries_to_wkb(df['geometry'])
+        cache = {'source': os.path.abspath(fullname),
+                 'mtime': stat.st_mtime, 'size': stat.st_size, 'df': df}
+        write_pickle(cache, geometry_cache_file(fullname))
+
     def lat_lon2point(self, df):
         """Create shapely point object of latitude and longitude."""
         return Point(df[self.lon_column], df[self.lat_column])
@@ -97,14 +285,15 @@ class Geometry:
         if lat_col is not None:
             self.lat_column = lat_col
         if wkt_column is not None:
-            self.df['geometry'] = self.df[wkt_column].apply(wkt_loads)
+            self.df['geometry'] = geometries_from_wkt(self.df[wkt_column])
             if not keep_wkt and wkt_column != 'geometry':
                 del self.df[wkt_column]
         elif ('geometry' not in self.df and self.lon_column in self.df and
                 self.lat_column in self.df):
-            self.df['geometry'] = self.df.apply(self.lat_lon2point, axis=1)
+            self.df['geometry'] = points_from_lon_lat(
+                self.df[self.lon_column], self.df[self.lat_column])
         elif isinstance(self.df.iloc[0]['geometry'], str):
-            self.df['geometry'] = self.df['geometry'].apply(wkt_loads)
+            self.df['geometry'] = geometries_from_wkt(self.df['geometry'])
         # else:
             # msg = "Could not create GeoDataFrame {0}. Missing geometries."
             # logging.error(msg.format(self.name))
@@ -116,6 +305,69 @@ class Geometry:
         self.df = None
         return self
 
+    def copy(self, name=None):
+        """Return a copy with its own GeoDataFrame. Use this to modify a
+        shared Geometry object of the registry."""
+        if name is None:
+            name = self.name
+        geo = Geometry(name=name)
+        geo.gdf = self.gdf.copy()
+        geo.simplified = self.simplified
+        geo.lon_column = self.lon_column
+        geo.lat_column = self.lat_column
+        return geo
+
+    def memory_usage(self):
+        """Approximate memory usage of the GeoDataFrame in bytes."""
+        if self.gdf is None:
+            return 0
+        geom = self.gdf.geometry.name
+        size = self.gdf.drop(columns=geom).memory_usage(deep=True).sum()
+        size += sum(len(g) for g in geometries_to_wkb(self.gdf[geom]))
+        return int(size)
+
+    def prepare(self, tolerance=None):
+        """Create a simplified inner and outer version of each polygon.
+
+        The inner polygon is within the original polygon and the outer polygon
+        contains the original polygon. Both are checked, failed versions are
+        set to None. A point within the inner polygon is within the original
+        polygon, a point outside the outer polygon is not. Only the remaining
+        points need a test against the original polygon (see
+        `within_pairs()`).
+
+        Parameters
+        ----------
+        tolerance : float
+            Tolerance of the simplification. Default: 1 % of the median
+            extent of the polygons.
+        """
+        if tolerance is None:
+            tolerance = np.median(np.sqrt(self.gdf.area)) * 0.01
+        inner = []
+        outer = []
+        for polygon in self.gdf.geometry:
+            try:
+                inn = polygon.buffer(-2 * tolerance).simplify(tolerance)
+                if inn.is_empty or not polygon.contains(inn):
+                    inn = None
+            except ValueError:
+                inn = None
+            try:
+                out = polygon.buffer(2 * tolerance).simplify(tolerance)
+                if not out.contains(polygon):
+                    out = None
+            except ValueError:
+                out = None
+            inner.append(inn)
+            outer.append(out)
+        self.simplified = pd.DataFrame({'inner': inner, 'outer': outer},
+                                       index=self.gdf.index)
+        logging.debug("Simplified polygons of {0} created ({1}/{2}).".format(
+            self.name, self.simplified['inner'].notnull().sum(),
+            self.simplified['outer'].notnull().sum()))
+        return self
+
     def get_df(self, geo_as_str=True):
         df = pd.DataFrame(self.gdf)
         if geo_as_str:
@@ -134,10 +386,532 @@ class Geometry:
         self.gdf.plot(*args, **kwargs)
 
 
+class GeometryRegistry:
+    """Process-wide store of shared Geometry objects.
+
+    The geometries are loaded on the first request by their logical name.
+    The names are defined in the [geometry_registry] section of the config
+    file (name = section, key of the file name). The same object is returned
+    on every request, so the objects must not be modified. Use
+    `Geometry.copy()` to get an object that can be changed. The spatial index
+    of a GeoDataFrame is built lazily on its first use and is shared as well.
+
+    If the memory usage of all objects exceeds max_memory (MB) the least
+    recently used objects are removed from the registry.
+
+    Examples
+    --------
+    >>> federal_states = registry.get('federal_states')  # doctest: +SKIP
+    """
+    def __init__(self, max_memory=None):
+        self.max_memory = max_memory
+        self.entries = OrderedDict()
+        self.sizes = {}
+        self.grid_indices = {}
+
+    def filename(self, name):
+        """Full name of the file of the geometry with the given name."""
+        section, key = cfg.get_list('geometry_registry', name)
+        return os.path.join(cfg.get('paths', 'geometry'),
+                            cfg.get(section, key))
+
+    def get(self, name):
+        """Get the shared Geometry object of the given name."""
+        if name in self.entries:
+            self.entries.move_to_end(name)
+            return self.entries[name]
+        geo = Geometry(name=name)
+        geo.load(fullname=self.filename(name))
+        if name in cfg.get_list('geometry_registry', 'prepare'):
+            geo.prepare()
+        self.entries[name] = geo
+        self.sizes[name] = geo.memory_usage()
+        logging.debug("Geometry '{0}' added to registry ({1} MB).".format(
+            name, round(self.sizes[name] / 1e6, 1)))
+        self.evict()
+        return geo
+
+    def memory_usage(self):
+        """Approximate memory usage of all objects in bytes."""
+        return sum(self.sizes.values())
+
+    def evict(self):
+        """Remove the least recently used objects until the memory usage is
+        below the limit. The last requested object is always kept."""
+        max_memory = self.max_memory
+        if max_memory is None:
+            max_memory = cfg.get('geometry_registry', 'max_memory')
+        while (self.memory_usage() > max_memory * 1e6 and
+               len(self.entries) > 1):
+            name, geo = self.entries.popitem(last=False)
+            del self.sizes[name]
+            logging.debug("Geometry '{0}' removed from registry.".format(name))
+
+    def grid_index(self, name):
+        """Get the GridIndex of the polygons of the given name. The index is
+        cached in the geometry cache path and rebuilt if the polygon file
+        changes."""
+        if name in self.grid_indices:
+            return self.grid_indices[name]
+        fullname = self.filename(name)
+        subdivision = cfg.get('geometry_registry', 'grid_subdivision')
+        cache_file = geometry_cache_file(fullname, extension='grid.npz')
+        index = GridIndex.load(cache_file, fullname, subdivision)
+        if index is None:
+            index = GridIndex.from_polygons(self.get(name), subdivision)
+            index.save(cache_file, fullname)
+        self.grid_indices[name] = index
+        return index
+
+    def clear(self):
+        """Remove all objects from the registry."""
+        self.entries.clear()
+        self.sizes.clear()
+        self.grid_indices.clear()
+
+
+class GridIndex:
+    """Point lookup for the cells of a regular grid (e.g. coastdat2).
+
+    The bounding box of the grid is divided into small bins (subdivision
+    bins per mean cell width and height). For every bin the lookup array
+    contains the id of the cell that covers the whole bin, 0 if the bin does
+    not touch any cell or -1 if the bin is crossed by a cell border. A point
+    is located by a simple index calculation. Only points in border bins need
+    an exact test against the polygons.
+
+    The cells of a rotated lat/lon grid are not rectangular in lon/lat, so the
+    bins cannot be aligned to the cells. A bin is covered by a convex cell if
+    all its corners are within the cell. Non-convex cells are treated as
+    border bins.
+
+    Attributes
+    ----------
+    lookup : numpy.ndarray
+        Cell id for each bin (rows: latitude, columns: longitude).
+    origin : tuple
+        Lower left corner of the lookup array (lon, lat).
+    spacing : tuple
+        Width and height of a bin (lon, lat).
+    subdivision : int
+    """
+    def __init__(self, lookup, origin, spacing, subdivision=None):
+        self.lookup = lookup
+        self.origin = tuple(origin)
+        self.spacing = tuple(spacing)
+        self.subdivision = subdivision
+
+    @classmethod
+    def from_polygons(cls, polygons, subdivision=16):
+        """Build the index from the Geometry object of the cells."""
+        gdf = polygons.gdf
+        bounds = gdf.bounds
+        x0, y0, x1, y1 = gdf.total_bounds
+        dx = (bounds.maxx - bounds.minx).mean() / subdivision
+        dy = (bounds.maxy - bounds.miny).mean() / subdivision
+        shape = (int(np.ceil((y1 - y0) / dy)), int(np.ceil((x1 - x0) / dx)))
+        lookup = np.zeros(shape, dtype=np.int64)
+
+        for gid, polygon, (minx, miny, maxx, maxy) in zip(
+                gdf.index, gdf.geometry, bounds.values):
+            i0 = int(np.floor((minx - x0) / dx))
+            i1 = min(int(np.floor((maxx - x0) / dx)), shape[1] - 1)
+            j0 = int(np.floor((miny - y0) / dy))
+            j1 = min(int(np.floor((maxy - y0) / dy)), shape[0] - 1)
+            part = lookup[j0:j1 + 1, i0:i1 + 1]
+
+            # All bins that touch the bounding box are border bins unless
+            # another cell covers them.
+            part[part == 0] = -1
+
+            if abs(polygon.convex_hull.area - polygon.area) > (
+                    polygon.area * 1e-9):
+                continue
+            x, y = np.meshgrid(x0 + np.arange(i0, i1 + 2) * dx,
+                               y0 + np.arange(j0, j1 + 2) * dy)
+            inside = points_in_polygon(polygon, x, y)
+            covered = (inside[:-1, :-1] & inside[:-1, 1:] &
+                       inside[1:, :-1] & inside[1:, 1:])
+            part[covered] = gid
+        msg = "Grid index with {0} bins created ({1} % border)."
+        logging.debug(msg.format(
+            lookup.size, round((lookup == -1).sum() / lookup.size * 100, 1)))
+        return cls(lookup, (x0, y0), (dx, dy), subdivision)
+
+    @classmethod
+    def load(cls, filename, source, subdivision):
+        """Load the index from a npz-file. Returns None if the file does not
+        exist or does not fit to the source file."""
+        if not os.path.isfile(filename):
+            return None
+        stat = os.stat(source)
+        try:
+            with np.load(filename) as data:
+                if (str(data['source']) != os.path.abspath(source) or
+                        float(data['mtime']) != stat.st_mtime or
+                        int(data['size']) != stat.st_size or
+                        int(data['subdivision']) != subdivision):
+                    logging.debug("Grid index {0} is outdated.".format(
+                        filename))
+                    return None
+                return cls(data['lookup'], data['origin'], data['spacing'],
+                           subdivision=subdivision)
+        except (OSError, EOFError, ValueError, KeyError,
+                zipfile.BadZipFile):
+            logging.warning("Cannot read grid index {0}.".format(filename))
+            return None
+
+    def save(self, filename, source):
+        """Save the index to a npz-file."""
+        stat = os.stat(source)
+        write_file_atomic(filename, lambda f: np.savez(
+            f, lookup=self.lookup, origin=self.origin, spacing=self.spacing,
+            subdivision=self.subdivision, source=os.path.abspath(source),
+            mtime=stat.st_mtime, size=stat.st_size))
+
+    def locate(self, lon, lat):
+        """Cell id for each point (lon, lat). The result is 0 if the point is
+        outside the grid and -1 if an exact test is needed."""
+        lon = np.asarray(lon, dtype=np.float64)
+        lat = np.asarray(lat, dtype=np.float64)
+        i = np.floor((lon - self.origin[0]) / self.spacing[0])
+        j = np.floor((lat - self.origin[1]) / self.spacing[1])
+        valid = ((i >= 0) & (i < self.lookup.shape[1]) &
+                 (j >= 0) & (j < self.lookup.shape[0]))
+        gid = np.zeros(len(lon), dtype=np.int64)
+        gid[valid] = self.lookup[j[valid].astype(np.int64),
+                                 i[valid].astype(np.int64)]
+        return gid
+
+
+registry = GeometryRegistry()
+
+
+def geometry_hash(gdf):
+    """Hash of the index and the geometries of a GeoDataFrame."""
+    sha = hashlib.sha1()
+    sha.update(str(list(gdf.index)).encode('utf-8'))
+    for value in geometries_to_wkb(gdf.geometry):
+        sha.update(value)
+    return sha.hexdigest()
+
+
+def intersecting_pairs(gdf_a, gdf_b):
+    """Positions of all pairs of geometries of gdf_a and gdf_b whose
+    bounding boxes intersect. The candidates are taken from the spatial index
+    of gdf_b."""
+    sindex = gdf_b.sindex
+    if hasattr(sindex, 'query_bulk'):
+        pos_a, pos_b = sindex.query_bulk(gdf_a.geometry)
+    else:
+        pos_a, pos_b = [], []
+        for n, geom in enumerate(gdf_a.geometry):
+            candidates = sorted(sindex.intersection(geom.bounds))
+            pos_a.extend([n] * len(candidates))
+            pos_b.extend(candidates)
+    return np.asarray(pos_a, dtype=np.int64), np.asarray(pos_b, dtype=np.int64)
+
+
+def intersection_table(geo_a, geo_b, cache=True):
+    """Area of the intersection of each pair of polygons of geo_a and geo_b.
+
+    The areas are calculated in an equal-area projection (EPSG:3035) and only
+    for pairs whose bounding boxes intersect. The table is cached in the
+    geometry cache path. The name of the cache file contains a hash of both
+    geometry tables, so a new or changed region set creates a new table.
+
+    Parameters
+    ----------
+    geo_a : reegis_tools.geometries.Geometry
+    geo_b : reegis_tools.geometries.Geometry
+    cache : bool
+        Use and write the cache file.
+
+    Returns
+    -------
+    pandas.DataFrame : Index: (id of geo_a, id of geo_b). Columns: area in
+        km², fraction_a (share of the area of geo_a), fraction_b (share of the
+        area of geo_b).
+
+    Examples
+    --------
+    >>> table = intersection_table(registry.get('de21'),
+    ...                            registry.get('coastdat2'))  # doctest: +SKIP
+    >>> weights = table['fraction_a']  # doctest: +SKIP
+    """
+    name_a = '_'.join(geo_a.name.split())
+    name_b = '_'.join(geo_b.name.split())
+    key = hashlib.sha1((geometry_hash(geo_a.gdf) + geometry_hash(
+        geo_b.gdf)).encode('utf-8')).hexdigest()
+    cache_file = os.path.join(
+        cfg.get('paths', 'geometry_cache'),
+        'intersection_{0}_{1}_{2}.pkl'.format(name_a, name_b, key[:12]))
+    if cache and os.path.isfile(cache_file):
+        logging.debug("Intersection table loaded from {0}".format(cache_file))
+        return pd.read_pickle(cache_file)
+
+    gdf_a = geo_a.gdf.to_crs(epsg=3035)
+    gdf_b = geo_b.gdf.to_crs(epsg=3035)
+
+    # Repair invalid polygons with a zero buffer.
+    for gdf in (gdf_a, gdf_b):
+        invalid = ~gdf.is_valid
+        if invalid.any():
+            logging.warning("{0} invalid geometries repaired.".format(
+                invalid.sum()))
+            gdf.loc[invalid, gdf.geometry.name] = gdf.loc[invalid].buffer(0)
+
+    pos_a, pos_b = intersecting_pairs(gdf_a, gdf_b)
+
+    geom_a = gpd.GeoSeries(gdf_a.geometry.values[pos_a])
+    geom_b = gpd.GeoSeries(gdf_b.geometry.values[pos_b])
+    area = geom_a.intersection(geom_b).area.values / 1e6
+
+    table = pd.DataFrame({
+        name_a: gdf_a.index.values[pos_a],
+        name_b: gdf_b.index.values[pos_b],
+        'area': area,
+        'fraction_a': area / (gdf_a.area.values[pos_a] / 1e6),
+        'fraction_b': area / (gdf_b.area.values[pos_b] / 1e6)})
+    table = table.loc[table['area'] > 0].set_index([name_a, name_b])
+    table = table[['area', 'fraction_a', 'fraction_b']].sort_index()
+    logging.info("Intersection table {0}/{1} with {2} pairs created.".format(
+        name_a, name_b, len(table)))
+
+    if cache:
+        write_pickle(table, cache_file)
+    return table
+
+
+class RegionMapping:
+    """Assignment of objects to the regions of a region set.
+
+    The objects (e.g. weather cells, municipalities, power plants) are
+    represented by points. The region of each point is stored by the kind of
+    the objects and the id of the point, so the regions can be re-used without
+    a spatial join. The mapping is stored in the geometry cache path. The file
+    name contains a hash of the region polygons, so changed regions start a
+    new mapping. Points with a new id or a new location are joined again.
+
+    Use `region_mapping()` to get the mapping of a region set.
+
+    Examples
+    --------
+    >>> de21 = registry.get('de21')  # doctest: +SKIP
+    >>> mapping = region_mapping(de21)  # doctest: +SKIP
+    >>> regions = mapping.assign('plant', plant_geometry)  # doctest: +SKIP
+    >>> regions = mapping.get('plant')  # doctest: +SKIP
+    """
+    def __init__(self, geo):
+        self.geo = geo
+        self.key = geometry_hash(geo.gdf)
+        self.filename = os.path.join(
+            cfg.get('paths', 'geometry_cache'),
+            'region_mapping_{0}_{1}.pkl'.format(
+                '_'.join(geo.name.split()), self.key[:12]))
+        self.tables = {}
+        if os.path.isfile(self.filename):
+            try:
+                self.tables = pd.read_pickle(self.filename)
+            except (OSError, EOFError, pickle.UnpicklingError):
+                logging.warning("Cannot read region mapping {0}.".format(
+                    self.filename))
+
+    def get(self, kind):
+        """Stored regions of all objects of the given kind (index: id of the
+        object). Returns None if the kind is unknown."""
+        if kind not in self.tables:
+            return None
+        return self.tables[kind]['region']
+
+    def assign(self, kind, points, **kwargs):
+        """Region of each point of the Geometry object. Points that are not
+        stored yet are joined with `spatial_join_with_buffer()` (kwargs) and
+        added to the mapping.
+
+        Parameters
+        ----------
+        kind : str
+            Kind of the objects (e.g. 'coastdat2', 'municipality', 'plant').
+        points : reegis_tools.geometries.Geometry
+            Point geometries with a unique index.
+
+        Returns
+        -------
+        pandas.Series : Region of each point.
+        """
+        gdf = points.gdf
+        table = pd.DataFrame({'x': gdf.geometry.x.values,
+                              'y': gdf.geometry.y.values},
+                             index=gdf.index)
+        old = self.tables.get(kind)
+        if old is not None:
+            table['region'] = old['region'].reindex(table.index)
+            known = old.reindex(table.index)
+            missing = ~((known['x'] == table['x']) &
+                        (known['y'] == table['y']))
+        else:
+            table['region'] = np.nan
+            missing = pd.Series(True, index=table.index)
+
+        if missing.any():
+            logging.info("Assigning {0} objects of kind '{1}' to {2}.".format(
+                missing.sum(), kind, self.geo.name))
+            rest = Geometry(name=points.name)
+            rest.gdf = gdf.loc[missing.values]
+            joined = spatial_join_with_buffer(
+                rest, self.geo, name='region', **kwargs)['region']
+            # Overlapping regions: the first region is taken.
+            joined = joined[~joined.index.duplicated(keep='first')]
+            table['region'] = table['region'].astype(object)
+            table.loc[missing.values, 'region'] = joined.reindex(
+                table.index[missing.values]).values
+            if old is not None:
+                table = pd.concat([old.drop(table.index, errors='ignore'),
+                                   table])
+            self.tables[kind] = table
+            write_pickle(self.tables, self.filename)
+        return table['region'].reindex(gdf.index)
+
+
+# Region mappings by the hash of the region polygons (see region_mapping).
+_region_mappings = {}
+
+
+def region_mapping(geo):
+    """Get the RegionMapping of the region set of the Geometry object."""
+    key = geometry_hash(geo.gdf)
+    if key not in _region_mappings:
+        _region_mappings[key] = RegionMapping(geo)
+    return _region_mappings[key]
+
+
+def within_pairs(points, polygons):
+    """Positions of all pairs of a point and a polygon where the point is
+    within the polygon.
+
+    The candidates are taken from the spatial index. If the polygons have
+    been prepared (see `Geometry.prepare()`) most candidates are decided by
+    the simplified polygons. The result is the same as the "within" operation
+    with the original polygons.
+
+    Parameters
+    ----------
+    points : geopandas.GeoDataFrame
+    polygons : reegis_tools.geometries.Geometry
+
+    Returns
+    -------
+    tuple : Positions of the points and the polygons sorted by the points.
+    """
+    pos_a, pos_b = intersecting_pairs(points, polygons.gdf)
+    x = points.geometry.x.values[pos_a]
+    y = points.geometry.y.values[pos_a]
+    within = np.zeros(len(pos_a), dtype=bool)
+    simplified = polygons.simplified
+    order = np.argsort(pos_b, kind='stable')
+    bounds = np.searchsorted(pos_b[order], np.arange(len(polygons.gdf) + 1))
+    for n, polygon in enumerate(polygons.gdf.geometry):
+        sel = order[bounds[n]:bounds[n + 1]]
+        if len(sel) == 0:
+            continue
+        undecided = np.ones(len(sel), dtype=bool)
+        if simplified is not None:
+            inner = simplified['inner'].iloc[n]
+            outer = simplified['outer'].iloc[n]
+            if inner is not None:
+                inside = points_in_polygon(inner, x[sel], y[sel])
+                within[sel[inside]] = True
+                undecided &= ~inside
+            if outer is not None:
+                undecided &= points_in_polygon(outer, x[sel], y[sel])
+        sel = sel[undecided]
+        within[sel] = points_in_polygon(polygon, x[sel], y[sel])
+    pos_a, pos_b = pos_a[within], pos_b[within]
+    order = np.lexsort((pos_b, pos_a))
+    return pos_a[order], pos_b[order]
+
+
+def join_points_within(points, polygons):
+    """Spatial left join of points within polygons. Returns the same table
+    as `gpd.sjoin(points, polygons.gdf, how='left', op='within')`."""
+    pos_a, pos_b = within_pairs(points, polygons)
+    unmatched = np.setdiff1d(np.arange(len(points)), pos_a)
+    pos_a = np.concatenate([pos_a, unmatched])
+    pos_b = np.concatenate([pos_b, np.full(len(unmatched), -1)])
+    order = np.argsort(pos_a, kind='stable')
+    pos_a, pos_b = pos_a[order], pos_b[order]
+
+    right = pd.DataFrame(polygons.gdf.drop(
+        columns=polygons.gdf.geometry.name))
+    right.insert(0, 'index_right', right.index)
+    right = right.reset_index(drop=True).reindex(pos_b)
+    jgdf = points.iloc[pos_a].copy()
+    for column in right.columns:
+        jgdf[column] = right[column].values
+    return jgdf
+
+
+def nearest_polygon(gdf, polygons, max_distance):
+    """Find the nearest polygon for each geometry within a maximal distance.
+
+    All geometries are queried at once with the nearest search of the spatial
+    index (geopandas >= 0.12, older versions use a slower loop). If two
+    polygons have the same distance, the first one (in order of the polygon
+    table) is taken.
+
+    Parameters
+    ----------
+    gdf : geopandas.GeoDataFrame
+    polygons : geopandas.GeoDataFrame
+    max_distance : float
+
+    Returns
+    -------
+    numpy.ndarray : Position of the nearest polygon for each row of gdf or -1
+        if no polygon is found within max_distance.
+    """
+    sindex = polygons.sindex
+    positions = np.full(len(gdf), -1, dtype=np.int64)
+    if len(gdf) == 0 or len(polygons) == 0:
+        return positions
+    try:
+        source, target = sindex.nearest(
+            gdf.geometry.values, return_all=True, max_distance=max_distance,
+            return_distance=False)
+    except (AttributeError, TypeError):
+        source = None
+    if source is not None:
+        # Take the first polygon if several have the same distance.
+        positions[:] = len(polygons)
+        np.minimum.at(positions, source, target)
+        positions[positions == len(polygons)] = -1
+        return positions
+
+    for n, geom in enumerate(gdf.geometry):
+        minx, miny, maxx, maxy = geom.bounds
+        candidates = sorted(sindex.intersection(
+            (minx - max_distance, miny - max_distance,
+             maxx + max_distance, maxy + max_distance)))
+        if len(candidates) == 0:
+            continue
+        distance = polygons.geometry.iloc[candidates].distance(geom).values
+        best = np.argmin(distance)
+        if distance[best] <= max_distance:
+            positions[n] = candidates[best]
+    return positions
+
+
 def spatial_join_with_buffer(geo1, geo2, jcol='index', name=None,
-                             step=0.05, limit=1):
+                             step=0.05, limit=1, method='buffer'):
     """Add name of containing region to new column for all points.
 
+    Geometries that are not within any region are matched with the method
+    'buffer' or 'nearest'. The 'buffer' method buffers the geometries step by
+    step up to the limit and takes the first intersecting region. The
+    'nearest' method takes the nearest region within the distance limit
+    in one query of the spatial index (see `nearest_polygon()`).
+
     Parameters
     ----------
     geo1 : reegis_tools.geometries.Geometry
@@ -146,19 +920,28 @@ def spatial_join_with_buffer(geo1, geo2, jcol='index', name=None,
     name : str
     step : float
     limit : float
+    method : str
+        Method to match the remaining geometries: 'buffer' or 'nearest'.
 
     Returns
     -------
     geopandas.geoDataFrame
 
     """
+    if method not in ('buffer', 'nearest'):
+        raise ValueError("Unknown method: '{0}'.".format(method))
+
     if jcol == 'index':
         jcol = 'index_right'
 
     logging.info("Doing spatial join...")
 
     # Spatial (left) join with the "within" operation.
-    jgdf = gpd.sjoin(geo1.gdf, geo2.gdf, how='left', op='within')
+    if geo2.simplified is not None and (
+            geo1.gdf.geom_type == 'Point').all():
+        jgdf = join_points_within(geo1.gdf, geo2)
+    else:
+        jgdf = gpd.sjoin(geo1.gdf, geo2.gdf, how='left', op='within')
     logging.info('Joined!')
 
     diff_cols = set(jgdf.columns) - set(geo1.gdf) - {jcol}
@@ -175,7 +958,21 @@ def spatial_join_with_buffer(geo1, geo2, jcol='index', name=None,
         msg = "{0} % non-matching geometries seems to be too high."
         logging.warning(msg.format(round(len_df / len(jgdf) * 100)))
 
-    while len_df > 0 and bf < limit:
+    if method == 'nearest' and len_df > 0:
+        missing = jgdf[jcol].isnull()
+        positions = nearest_polygon(jgdf.loc[missing], geo2.gdf, limit)
+        if jcol == 'index_right':
+            labels = geo2.gdf.index
+        else:
+            labels = geo2.gdf[jcol]
+        values = pd.Series(np.nan, index=range(len(positions)), dtype=object)
+        values[positions >= 0] = labels.values[positions[positions >= 0]]
+        jgdf.loc[missing, jcol] = values.values
+        len_df = len(jgdf.loc[jgdf[jcol].isnull()])
+        logging.info("Nearest polygon: {0}, Remaining_length: {1}".format(
+            limit, len_df))
+
+    while method == 'buffer' and len_df > 0 and bf < limit:
         # Increase the buffer by step.
         bf += step
 
@@ -233,3 +1030,145 @@ def spatial_join_with_buffer(geo1, geo2, jcol='index', name=None,
     logging.info(
         "New column '{0}' added to GeoDataFrame.".format(name))
     return jgdf
+
+
+# Polygons of the spatial join in a worker process (see init_join_worker).
+_join_polygons = None
+
+
+def init_join_worker(polygons):
+    """Initialise a worker process of `spatial_join_in_chunks()`. The spatial
+    index of the polygons is built once per process."""
+    global _join_polygons
+    _join_polygons = polygons
+    _join_polygons.gdf.sindex
+
+
+def join_worker(task):
+    """Join a chunk of geometries with the polygons of the worker process."""
+    chunk, kwargs = task
+    geo = Geometry(name='chunk')
+    geo.gdf = chunk
+    return spatial_join_with_buffer(geo, _join_polygons, **kwargs)[
+        kwargs['name']]
+
+
+def spatial_join_in_chunks(geo1, geo2, jcol='index', name=None,
+                           chunksize=100000, processes=None, **kwargs):
+    """Spatial join of large point sets in chunks using a process pool.
+
+    Only the geometry column of geo1 and the join column of geo2 are passed to
+    the worker processes. Each chunk is joined with `spatial_join_with_buffer`
+    and the resulting column is added to a copy of geo1.gdf. Sets with less
+    than two chunks are joined in the current process.
+
+    Parameters
+    ----------
+    geo1 : reegis_tools.geometries.Geometry
+    geo2 : reegis_tools.geometries.Geometry
+    jcol : str
+    name : str
+    chunksize : int
+        Number of rows of geo1 per chunk.
+    processes : int
+        Number of worker processes. Default: number of cpus but not more than
+        the number of chunks.
+    kwargs :
+        Parameters for `spatial_join_with_buffer()` (step, limit, method).
+
+    Returns
+    -------
+    geopandas.geoDataFrame
+
+    """
+    if name is None:
+        name = "_".join(geo2.name.split())
+    kwargs.update({'jcol': jcol, 'name': name})
+
+    polygons = Geometry(name=geo2.name)
+    columns = [geo2.gdf.geometry.name]
+    if jcol != 'index':
+        columns.append(jcol)
+    polygons.gdf = geo2.gdf[columns]
+    # Keep the simplified polygons of a prepared Geometry (see
+    # `Geometry.prepare()`).
+    polygons.simplified = geo2.simplified
+
+    points = geo1.gdf[[geo1.gdf.geometry.name]]
+    tasks = [(points.iloc[n:n + chunksize], kwargs)
+             for n in range(0, len(points), chunksize)]
+    logging.info("Spatial join of {0} geometries in {1} chunks.".format(
+        len(points), len(tasks)))
+
+    if len(tasks) > 1:
+        if processes is None:
+            processes = min(multiprocessing.cpu_count(), len(tasks))
+        pool = multiprocessing.Pool(processes, initializer=init_join_worker,
+                                    initargs=(polygons,))
+        try:
+            results = pool.map(join_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        init_join_worker(polygons)
+        results = [join_worker(task) for task in tasks]
+
+    jgdf = geo1.gdf.copy()
+    if name in jgdf:
+        del jgdf[name]
+    jgdf = jgdf.join(pd.concat(results))
+    logging.info(
+        "New column '{0}' added to GeoDataFrame.".format(name))
+    return jgdf
+
+
+def spatial_join_with_grid(geo1, grid_name, name=None, **kwargs):
+    """Add the id of the containing grid cell to a new column for all points.
+
+    Same result as `spatial_join_with_buffer()` with the cells of the grid
+    (e.g. 'coastdat2') but most points are located by the GridIndex of the
+    registry. Only points near a cell border or outside the grid are joined
+    with the polygons.
+
+    Parameters
+    ----------
+    geo1 : reegis_tools.geometries.Geometry
+        Point geometries.
+    grid_name : str
+        Name of the grid polygons in the geometry registry.
+    name : str
+        Name of the new column. Default: grid_name
+    kwargs :
+        Parameters for `spatial_join_with_buffer()`.
+
+    Returns
+    -------
+    geopandas.geoDataFrame
+
+    """
+    if name is None:
+        name = grid_name
+    index = registry.grid_index(grid_name)
+    gdf = geo1.gdf
+    gid = index.locate(gdf.geometry.x, gdf.geometry.y)
+    exact = gid <= 0
+    logging.info("{0} of {1} points located by the grid index.".format(
+        len(gid) - exact.sum(), len(gid)))
+
+    if exact.any():
+        rest = Geometry(name=geo1.name)
+        rest.gdf = gdf.loc[exact]
+        rest_gid = spatial_join_with_buffer(
+            rest, registry.get(grid_name), name=name, **kwargs)[name]
+        values = pd.Series(gid, index=gdf.index, dtype=object)
+        values.loc[exact] = [
+            v if isinstance(v, str) else int(v) for v in rest_gid.values]
+    else:
+        values = pd.Series(gid, index=gdf.index)
+
+    jgdf = gdf.copy()
+    jgdf[name] = values
+    logging.info(
+        "New column '{0}' added to GeoDataFrame.".format(name))
+    return jgdf
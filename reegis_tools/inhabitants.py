@@ -105,15 +105,13 @@ def get_ew_by_region(year, geo, col=None):
     if col is None:
         col = geo.name
     ew = get_ew_geometry(year)
-    ew.gdf = reegis_tools.geometries.spatial_join_with_buffer(
-        ew, geo)
+    ew.gdf[col] = reegis_tools.geometries.region_mapping(geo).assign(
+        'municipality', ew)
     return ew.gdf.groupby(col).sum()['EWZ']
 
 
 def get_ew_by_federal_states(year):
-    geo = reegis_tools.geometries.Geometry(name='federal_state')
-    geo.load(cfg.get('paths', 'geometry'),
-             cfg.get('geometry', 'federalstates_polygon'))
+    geo = reegis_tools.geometries.registry.get('federal_states')
     return get_ew_by_region(year, geo)
 
 
@@ -29,9 +29,7 @@ def prepare_ego_demand(egofile):
     ego_demand.create_geo_df(wkt_column='st_astext')
 
     # Add column with name of the federal state (Bayern, Berlin,...)
-    federal_states = geometries.Geometry('federal states')
-    federal_states.load(cfg.get('paths', 'geometry'),
-                        cfg.get('geometry', 'federalstates_polygon'))
+    federal_states = geometries.registry.get('federal_states')
 
     # Add column with federal_states
     ego_demand.gdf = geometries.spatial_join_with_buffer(
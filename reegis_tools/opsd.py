@@ -14,6 +14,8 @@ __license__ = "GPLv3"
 import os
 import logging
 import datetime
+import contextlib
+import multiprocessing
 
 # External libraries
 import numpy as np
@@ -28,6 +30,7 @@ from oemof.tools import logger
 # Internal modules
 import reegis_tools.config as cfg
 import reegis_tools.geometries as geo
+import reegis_tools.tools as tools
 
 
 def convert_utm_code_opsd(df):
@@ -55,50 +58,83 @@ def convert_utm_code_opsd(df):
     return df
 
 
+# Postcode centroids by file name (see get_postcode_centroids).
+_postcode_centroids = {}
+
+
+def get_postcode_centroids():
+    """Centroid (lon, lat) of each postcode polygon (index: postcode). The
+    table is created once per process."""
+    filename = os.path.join(cfg.get('paths', 'geometry'),
+                            cfg.get('geometry', 'postcode_polygon'))
+    if filename not in _postcode_centroids:
+        pstc = pd.read_csv(filename, index_col='zip_code')
+        pstc = pstc.loc[~pstc.index.duplicated(keep='first')]
+        pstc = pd.DataFrame({'geometry': pstc.iloc[:, 0]})
+        postcodes = geo.Geometry(name='postcodes', df=pstc)
+        postcodes.create_geo_df()
+        centroids = postcodes.gdf.centroid
+        _postcode_centroids[filename] = pd.DataFrame(
+            {'lon': centroids.x, 'lat': centroids.y})
+    return _postcode_centroids[filename]
+
+
+def postcode2int(postcodes):
+    """Convert postcodes to integers. Postcodes that are not a number (e.g.
+    '123XX') are converted to NaN."""
+    codes = {}
+    for postcode in postcodes.unique():
+        try:
+            codes[postcode] = int(postcode)
+        except ValueError:
+            codes[postcode] = np.nan
+    return postcodes.map(codes)
+
+
 def guess_coordinates_by_postcode_opsd(df):
     # *** Use postcode ***
     if 'postcode' in df:
-        df_pstc = df.loc[(df.lon.isnull() & df.postcode.notnull())]
-        if len(df_pstc) > 0:
-            pstc = pd.read_csv(
-                os.path.join(cfg.get('paths', 'geometry'),
-                             cfg.get('geometry', 'postcode_polygon')),
-                index_col='zip_code')
-        for idx, val in df_pstc.iterrows():
-            try:
-                # If the postcode is not number the integer conversion will
-                # raise a ValueError. Some postcode look like this '123XX'.
-                # It would be possible to add the mayor regions to the postcode
-                # map in order to search for the first two/three digits.
-                postcode = int(val.postcode)
-                if postcode in pstc.index:
-                    df.loc[df.id == val.id, 'lon'] = wkt_loads(
-                        pstc.loc[postcode].values[0]).centroid.x
-                    df.loc[df.id == val.id, 'lat'] = wkt_loads(
-                        pstc.loc[postcode].values[0]).centroid.y
-                # Replace the last number with a zero and try again.
-                elif round(postcode / 10) * 10 in pstc.index:
-                    postcode = round(postcode / 10) * 10
-                    df.loc[df.id == val.id, 'lon'] = wkt_loads(
-                        pstc.loc[postcode].values[0]).centroid.x
-                    df.loc[df.id == val.id, 'lat'] = wkt_loads(
-                        pstc.loc[postcode].values[0]).centroid.y
-                else:
-                    logging.debug("Cannot find postcode {0}.".format(postcode))
-            except ValueError:
-                logging.debug("Cannot find postcode {0}.".format(val.postcode))
+        missing = df.lon.isnull() & df.postcode.notnull()
+        if missing.any():
+            pstc = get_postcode_centroids()
+
+            # If the postcode is not a number it cannot be found. Some
+            # postcodes look like this '123XX'. It would be possible to add
+            # the mayor regions to the postcode map in order to search for the
+            # first two/three digits.
+            postcode = postcode2int(df.loc[missing, 'postcode'])
+
+            # Replace the last number with a zero if the postcode is unknown.
+            postcode = postcode.where(postcode.isin(pstc.index),
+                                      (postcode / 10).round() * 10)
+            found = postcode.isin(pstc.index)
+            coordinates = pstc.loc[postcode[found].astype(int)]
+
+            fill = missing.copy()
+            fill[missing] = found.values
+            df.loc[fill, 'lon'] = coordinates['lon'].values
+            df.loc[fill, 'lat'] = coordinates['lat'].values
+            logging.debug("Cannot find {0} postcodes.".format(
+                (~found).sum()))
     return df
 
 
-def guess_coordinates_by_spatial_names_opsd(df, fs_column, cap_col,
-                                            total_cap, stat):
-    # *** Use municipal_code and federal_state to define coordinates ***
+def fix_federal_state_names_opsd(df, fs_column):
+    """Mark plants in the exclusive economic zone (AWZ)."""
     if fs_column in df:
         if 'municipality_code' in df:
             if df.municipality_code.dtype == str:
                 df.loc[df.municipality_code == 'AWZ', fs_column] = 'AWZ_NS'
         if 'postcode' in df:
             df.loc[df.postcode == '000XX', fs_column] = 'AWZ'
+    return df
+
+
+def guess_coordinates_by_spatial_names_opsd(df, fs_column, cap_col,
+                                            total_cap, stat):
+    # *** Use municipal_code and federal_state to define coordinates ***
+    if fs_column in df:
+        fix_federal_state_names_opsd(df, fs_column)
         states = df.loc[df.lon.isnull()].groupby(
             fs_column).sum()[cap_col]
         logging.debug("Fraction of undefined capacity by federal state " +
@@ -137,75 +173,239 @@ def log_undefined_capacity(df, cap_col, total_cap, msg):
 
 
 def complete_opsd_geometries(df, category, time=None,
-                             fs_column='federal_state'):
+                             fs_column='federal_state', report=None):
     """
     Try different methods to fill missing coordinates.
+
+    The resolved coordinates and the method used are stored in a cache file
+    together with the source fields of each plant (see
+    `geocoding_source_opsd()`). The cache is keyed on the plant id (see
+    `geocoding_keys_opsd()`). Only plants that are new or whose source
+    fields have changed go through the methods again.
+
+    A table can be completed in chunks. Pass the same report (see
+    `geometry_report_opsd()`) for all chunks and write it with
+    `write_geometry_report_opsd()` afterwards. Without a report the report of
+    the table is written directly.
     """
     cap_col = 'capacity'
+    keys = geocoding_keys_opsd(df, category)
 
-    if 'id' not in df:
-        df['id'] = df.index
-        no_id = True
-    else:
-        no_id = False
+    single = report is None
+    if single:
+        report = geometry_report_opsd(category, fs_column, time)
 
-    if time is None:
-        time = datetime.datetime.now()
+    fix_federal_state_names_opsd(df, fs_column)
 
     # Get index of incomplete rows.
     incomplete = df.lon.isnull()
 
-    statistics = pd.DataFrame()
-
     # Calculate total capacity
     total_capacity = df[cap_col].sum()
-    statistics.loc['original', 'undefined_capacity'] = log_undefined_capacity(
+    log_undefined_capacity(
         df, cap_col, total_capacity,
         "IDs without coordinates found. Trying to fill the gaps.")
 
-    df = convert_utm_code_opsd(df)
-    statistics.loc['utm', 'undefined_capacity'] = log_undefined_capacity(
-        df, cap_col, total_capacity,
-        "Reduced undefined plants by utm conversion.")
-
-    df = guess_coordinates_by_postcode_opsd(df)
-    statistics.loc['postcode', 'undefined_capacity'] = log_undefined_capacity(
-        df, cap_col, total_capacity, "Reduced undefined plants by postcode.")
-
-    df = guess_coordinates_by_spatial_names_opsd(
-        df, fs_column, cap_col, total_capacity, statistics)
-    statistics.loc['name', 'undefined_capacity'] = log_undefined_capacity(
-        df, cap_col, total_capacity,
-        "Reduced undefined plants by federal_state centroid.")
+    # Take the coordinates from the cache if the source fields are unchanged.
+    source = geocoding_source_opsd(df.loc[incomplete], fs_column)
+    cached = report['cache'].reindex(keys[incomplete])
+    # Plants without an id are never taken from the cache.
+    valid = ((cached['source'] == source.values).values &
+             keys[incomplete].notnull().values)
+    df.loc[incomplete, 'lon'] = np.where(
+        valid, cached['lon'].astype(float), np.nan)
+    df.loc[incomplete, 'lat'] = np.where(
+        valid, cached['lat'].astype(float), np.nan)
+    method = pd.Series(np.where(valid, cached['method'], None),
+                       index=df.loc[incomplete].index, dtype=object)
+    method[method == ''] = None
+    new = incomplete.copy()
+    new[incomplete] = ~valid
+    logging.info("Coordinates of {0} plants taken from the cache.".format(
+        valid.sum()))
+
+    # Fill the gaps of new or changed plants.
+    if new.any():
+        sub = df.loc[new].copy()
+        steps = [('utm', convert_utm_code_opsd),
+                 ('postcode', guess_coordinates_by_postcode_opsd),
+                 ('name', lambda x: guess_coordinates_by_spatial_names_opsd(
+                     x, fs_column, cap_col, total_capacity, pd.DataFrame()))]
+        for name, step in steps:
+            sub = step(sub)
+            found = sub.index[sub.lon.notnull().values &
+                              method.loc[sub.index].isnull().values]
+            method.loc[found] = name
+            logging.debug("Coordinates of {0} plants found by {1}.".format(
+                len(found), name))
+        df.loc[new, 'lon'] = sub['lon']
+        df.loc[new, 'lat'] = sub['lat']
+
+    entries = pd.DataFrame(
+        {'source': source.values,
+         'lon': df.loc[incomplete, 'lon'].values,
+         'lat': df.loc[incomplete, 'lat'].values,
+         'method': method.values},
+        index=keys[incomplete].values)
+    report['entries'].append(entries.loc[entries.index.notnull()])
+    plants = pd.DataFrame({cap_col: df.loc[incomplete, cap_col],
+                           'method': method})
+    if fs_column in df:
+        plants[fs_column] = df.loc[incomplete, fs_column]
+    report['plants'].append(plants)
+    report['total_capacity'] += total_capacity
+    log_undefined_capacity(df, cap_col, total_capacity,
+                           "Reduced undefined plants by all methods.")
 
     # Store table of undefined sets to csv-file
+    write_header = report['chunks'] == 0
+    mode = 'w' if write_header else 'a'
     if incomplete.any():
         df.loc[incomplete].to_csv(os.path.join(
             cfg.get('paths', 'messages'),
-            '{0}_incomplete_geometries_before.csv'.format(category)))
+            '{0}_incomplete_geometries_before.csv'.format(category)),
+            mode=mode, header=write_header)
 
     incomplete = df.lon.isnull()
     if incomplete.any():
         df.loc[incomplete].to_csv(os.path.join(
             cfg.get('paths', 'messages'),
-            '{0}_incomplete_geometries_after.csv'.format(category)))
+            '{0}_incomplete_geometries_after.csv'.format(category)),
+            mode=mode, header=write_header)
+    report['chunks'] += 1
+
+    if single:
+        write_geometry_report_opsd(report)
+
+    return df
+
+
+def geocoding_keys_opsd(df, category):
+    """The plant id of each row as key of the geocoding cache. The id column
+    of a category is defined in the config file ([opsd] {cat}_id). The index
+    is used if the column is missing. Missing ids stay NaN."""
+    id_col = cfg.get('opsd', '{0}_id'.format(category))
+    if id_col in df:
+        ids = df[id_col]
+    else:
+        ids = pd.Series(df.index, index=df.index)
+    return ids.where(ids.isnull(), ids.astype(str))
+
+
+# Lock of the shared cache files while the categories are prepared in
+# separate processes (see `opsd_power_plants()`).
+_hdf_lock = None
+
+
+def hdf_lock():
+    """Lock of the hdf cache files shared by all categories. Does nothing
+    outside the worker processes of `opsd_power_plants()`."""
+    if _hdf_lock is None:
+        return contextlib.suppress()
+    return _hdf_lock
+
+
+def geometry_report_opsd(category, fs_column='federal_state', time=None,
+                         keep_cache=False):
+    """Create an empty report of `complete_opsd_geometries()`. The geocoding
+    cache of the category is loaded once for all chunks of a table. With
+    keep_cache=True the new entries are merged into the existing cache instead
+    of replacing it (used if only a part of a table is prepared)."""
+    if time is None:
+        time = datetime.datetime.now()
+    return {'category': category, 'fs_column': fs_column, 'time': time,
+            'cache': load_geocoding_cache_opsd(category), 'entries': [],
+            'plants': [], 'total_capacity': 0, 'chunks': 0,
+            'keep_cache': keep_cache}
+
+
+def write_geometry_report_opsd(report, cap_col='capacity'):
+    """Store the geocoding cache and the statistics of all completed chunks
+    and log the results."""
+    category = report['category']
+    if len(report['entries']) > 0:
+        entries = pd.concat(report['entries'])
+        if report.get('keep_cache', False):
+            cache = report['cache']
+            entries = pd.concat(
+                [cache.loc[~cache.index.isin(entries.index)], entries])
+        store_geocoding_cache_opsd(category, entries)
+        plants = pd.concat(report['plants'])
+    else:
+        plants = pd.DataFrame(columns=[cap_col, 'method'])
     logging.debug("Gaps stored to: {0}".format(cfg.get('paths', 'messages')))
 
-    statistics['total_capacity'] = total_capacity
+    statistics = geocoding_statistics_opsd(
+        plants, plants['method'], report['fs_column'], cap_col)
+    statistics['total_capacity'] = report['total_capacity']
     statistics.to_csv(os.path.join(cfg.get('paths', 'messages'),
                                    'statistics_{0}_pp.csv'.format(category)))
 
     # Log information
-    geo_check = not df.lon.isnull().any()
+    geo_check = not plants['method'].isnull().any()
     if not geo_check:
         logging.warning("Plants with unknown geometry.")
     logging.info('Geometry check: {0}'.format(str(geo_check)))
     logging.info("Geometry supplemented: {0}".format(
-        str(datetime.datetime.now() - time)))
-
-    if no_id:
-        del df['id']
-    return df
+        str(datetime.datetime.now() - report['time'])))
+
+
+def geocoding_source_opsd(df, fs_column):
+    """The source fields used to find the coordinates of each plant as one
+    string."""
+    source = pd.Series('', index=df.index)
+    for col in ['utm_zone', 'utm_east', 'utm_north', 'postcode', fs_column,
+                'municipality_code']:
+        if col in df:
+            source = source + '|' + df[col].astype(str)
+    return source
+
+
+def geocoding_cache_file_opsd():
+    return os.path.join(cfg.get('paths', 'opsd'),
+                        cfg.get('opsd', 'geocoding_cache'))
+
+
+def load_geocoding_cache_opsd(category):
+    """Load the geocoding cache of the category. Returns an empty table if no
+    cache exists."""
+    try:
+        with hdf_lock():
+            cache = pd.read_hdf(geocoding_cache_file_opsd(), category,
+                                mode='r')
+    except (KeyError, IOError):
+        cache = pd.DataFrame(columns=['source', 'lon', 'lat', 'method'])
+    return cache.loc[~cache.index.duplicated(keep='first')]
+
+
+def store_geocoding_cache_opsd(category, cache):
+    """Store the geocoding cache of the category."""
+    cache = cache.copy()
+    cache['method'] = cache['method'].fillna('').astype(str)
+    cache['lon'] = cache['lon'].astype(float)
+    cache['lat'] = cache['lat'].astype(float)
+    with hdf_lock():
+        cache.to_hdf(geocoding_cache_file_opsd(), category, mode='a')
+    logging.debug("Geocoding cache of {0} plants stored.".format(len(cache)))
+
+
+def geocoding_statistics_opsd(df, method, fs_column, cap_col):
+    """Undefined capacity after each method of `complete_opsd_geometries()`
+    and by federal state before the last method."""
+    statistics = pd.DataFrame()
+    undefined = df[cap_col].sum()
+    statistics.loc['original', 'undefined_capacity'] = undefined
+    for name in ['utm', 'postcode']:
+        undefined -= df.loc[method == name, cap_col].sum()
+        statistics.loc[name, 'undefined_capacity'] = undefined
+    if fs_column in df:
+        left = df.loc[~method.isin(['utm', 'postcode'])]
+        states = left.groupby(fs_column).sum()[cap_col]
+        for (state, capacity) in states.iteritems():
+            statistics.loc[state, 'undefined_capacity'] = capacity
+    statistics.loc['name', 'undefined_capacity'] = df.loc[
+        method.isnull(), cap_col].sum()
+    return statistics
 
 
 def remove_cols(df, cols):
@@ -218,8 +418,15 @@ def remove_cols(df, cols):
     return df
 
 
-def load_original_opsd_file(category, overwrite, latest=False):
-    """Read file if exists."""
+def load_original_opsd_file(category, overwrite, latest=False,
+                            chunksize=None):
+    """Read file if exists.
+
+    The renewable file is read with fixed types and without the columns that
+    are not used (see [opsd_renewable_dtypes] and [opsd_renewable_skip] in the
+    config file). If a chunksize is given an iterator over the chunks is
+    returned.
+    """
 
     orig_csv_file = os.path.join(
         cfg.get('paths', 'opsd'),
@@ -255,7 +462,10 @@ def load_original_opsd_file(category, overwrite, latest=False):
             fout.write(req.content)
 
     if category == 'renewable':
-        df = pd.read_csv(orig_csv_file)
+        skip = cfg.get_list('opsd', 'renewable_skip_columns')
+        df = pd.read_csv(orig_csv_file,
+                         dtype=cfg.get_dict('opsd_renewable_dtypes'),
+                         usecols=lambda c: c not in skip, chunksize=chunksize)
     elif category == 'conventional':
         df = pd.read_csv(orig_csv_file, index_col=[0])
     else:
@@ -289,12 +499,8 @@ def prepare_dates(df, date_cols, month):
         df['decom_month'] = 6
 
 
-def prepare_opsd_file(category, prepared_file_name, overwrite):
-    # Load original opsd file
-    df = load_original_opsd_file(category, overwrite)
-
-    # Load original file and set differences between conventional and
-    # renewable power plants.
+def prepare_settings_opsd(category):
+    """Columns to remove, date columns and the month flag of a category."""
     if category == 'renewable':
         # capacity_column = 'electrical_capacity'
         remove_list = [
@@ -304,7 +510,6 @@ def prepare_opsd_file(category, prepared_file_name, overwrite):
                 'data_source']
         date_cols = ('commissioning_date', 'decommissioning_date')
         month = True
-
     elif category == 'conventional':
         # capacity_column = 'capacity_net_bnetza'
         remove_list = None
@@ -313,17 +518,150 @@ def prepare_opsd_file(category, prepared_file_name, overwrite):
     else:
         logging.error("Unknown category!")
         return None
+    return remove_list, date_cols, month
+
+
+def prepare_opsd_chunks(category, overwrite, latest=False):
+    """Prepare the original opsd table of a category chunk by chunk (the
+    renewable table in chunks of [opsd] chunksize rows, see
+    `prepare_opsd_chunk()`). The row hashes of each chunk are appended to the
+    hash file. The geocoding report is written after the last chunk.
+
+    Yields
+    ------
+    pandas.DataFrame : Prepared chunk.
+    """
+    settings = prepare_settings_opsd(category)
+    if settings is None:
+        return
         # This function is adapted to the OPSD data set structure and might not
         # work with other data sets. Set opsd=False to skip it.
+    remove_list, date_cols, month = settings
+
+    if category == 'renewable':
+        # The large renewable file is prepared in chunks.
+        chunks = load_original_opsd_file(
+            category, overwrite, latest=latest,
+            chunksize=cfg.get('opsd', 'chunksize'))
+    else:
+        chunks = [load_original_opsd_file(category, overwrite, latest=latest)]
+
+    report = geometry_report_opsd(category, fs_column='state')
+    for n, df in enumerate(chunks):
+        # The row hashes are the base of an incremental update of the tables.
+        store_row_hashes_opsd(category, row_hashes_opsd(df, category),
+                              append=n > 0)
+        yield prepare_opsd_chunk(df, report, remove_list, date_cols, month)
+
+    if report['chunks'] > 0:
+        write_geometry_report_opsd(report)
+    else:
+        logging.info("Skipped 'complete_opsd_geometries' function.")
+
+
+def prepare_opsd_file(category, prepared_file_name, overwrite, latest=False):
+    # Each prepared chunk is appended to the csv-file, so only one chunk is
+    # kept in memory while the file is prepared.
+    first = True
+    for df in prepare_opsd_chunks(category, overwrite, latest=latest):
+        df.to_csv(prepared_file_name, mode='w' if first else 'a',
+                  header=first)
+        first = False
+    if first:
+        return None
+    return pd.read_csv(prepared_file_name, index_col=[0])
+
+
+def row_hashes_opsd(df, category):
+    """The plant id and a hash of each row of an original opsd table. The id
+    column of a category is defined in the config file ([opsd] {cat}_id)."""
+    id_col = cfg.get('opsd', '{0}_id'.format(category))
+    if id_col == 'index':
+        ids = df.index
+    else:
+        ids = df[id_col]
+    return pd.DataFrame(
+        {'id': np.asarray(ids).astype(str),
+         'hash': pd.util.hash_pandas_object(row_values_opsd(df, category),
+                                            index=False).values},
+        index=df.index)
+
+
+def row_values_opsd(df, category):
+    """Representation of an original opsd table to hash its rows.
+
+    Columns with a dtype defined in the config file
+    ([opsd_renewable_dtypes]) are kept. All other columns are converted to
+    text that does not depend on the dtype inferred for a chunk or a
+    release: numbers are written as floats (1 and 1.0 are equal) and missing
+    values as empty strings.
+    """
+    if category == 'renewable':
+        fixed = cfg.get_dict('opsd_renewable_dtypes')
+    else:
+        fixed = {}
+    values = {}
+    for col in df.columns:
+        if col in fixed:
+            values[col] = df[col]
+        elif df[col].dtype.kind in 'iuf':
+            values[col] = df[col].astype(float).astype(str).replace('nan', '')
+        else:
+            column = df[col].astype(object)
+            text = column.where(column.isnull(), column.astype(str)).fillna('')
+            numbers = pd.to_numeric(text, errors='coerce')
+            if numbers.notnull().any():
+                text = text.where(numbers.isnull(),
+                                  numbers.astype(float).astype(str))
+            values[col] = text
+    return pd.DataFrame(values, index=df.index)
+
+
+def row_keys_opsd(hashes):
+    """A unique key for each row of a hash table: the plant id and the number
+    of the occurrence of the id (ids are missing or duplicated in some
+    releases)."""
+    return (hashes['id'] + '#' +
+            hashes.groupby('id').cumcount().astype(str)).values
+
+
+def row_hash_file_opsd():
+    return os.path.join(cfg.get('paths', 'opsd'),
+                        cfg.get('opsd', 'row_hashes'))
+
+
+def load_row_hashes_opsd(category):
+    """Load the row hashes of the last prepared release. Returns None if no
+    hashes exist."""
+    try:
+        hashes = pd.read_hdf(row_hash_file_opsd(), category, mode='r')
+    except (KeyError, IOError):
+        return None
+    # Missing ids are stored as 'nan' and read as NaN by pytables.
+    hashes['id'] = hashes['id'].fillna('nan')
+    return hashes
+
+
+def store_row_hashes_opsd(category, hashes, append=False):
+    """Store (or append) the row hashes of a category (see
+    `row_hashes_opsd()`)."""
+    with hdf_lock():
+        hashes.to_hdf(row_hash_file_opsd(), category, mode='a',
+                      format='table', append=append,
+                      min_itemsize={'id': 64})
+    logging.debug("Row hashes of {0} plants stored.".format(len(hashes)))
 
+
+def prepare_opsd_chunk(df, report, remove_list, date_cols, month):
+    """Prepare a chunk of an original opsd table (see
+    `prepare_opsd_file()`)."""
     df = df.rename(columns={'electrical_capacity': 'capacity',
                             'capacity_net_bnetza': 'capacity',
                             'efficiency_estimate': 'efficiency'})
 
     if len(df.loc[df.lon.isnull()]) > 0:
-        df = complete_opsd_geometries(df, category, fs_column='state')
-    else:
-        logging.info("Skipped 'complete_opsd_geometries' function.")
+        df = complete_opsd_geometries(df, report['category'],
+                                      fs_column='state', report=report)
 
         # Remove power plants with no capacity:
     number = len(df[df['capacity'].isnull()])
@@ -337,70 +675,147 @@ def prepare_opsd_file(category, prepared_file_name, overwrite):
         df = remove_cols(df, remove_list)
 
     prepare_dates(df, date_cols, month)
-
-    df.to_csv(prepared_file_name)
     return df
 
 
-def load_opsd_file(category, overwrite, prepared=True):
+def load_opsd_file(category, overwrite, prepared=True, latest=False):
     if prepared:
         prepared_file_name = os.path.join(
             cfg.get('paths', 'opsd'),
             cfg.get('opsd', 'cleaned_csv_file_pattern').format(
                 cat=category))
         if not os.path.isfile(prepared_file_name) or overwrite:
-            df = prepare_opsd_file(category, prepared_file_name, overwrite)
+            df = prepare_opsd_file(category, prepared_file_name, overwrite,
+                                   latest=latest)
         else:
             df = pd.read_csv(prepared_file_name, index_col=[0])
     else:
-        df = load_original_opsd_file(category, overwrite)
+        df = load_original_opsd_file(category, overwrite, latest=latest)
     return df
 
 
-def opsd_power_plants(overwrite=False, csv=False):
+def prepare_category(category, filename, overwrite=False, latest=False,
+                     csv=False):
+    """Prepare the power plants of a category chunk by chunk.
+
+    Each chunk is cleaned and completed (see `prepare_opsd_chunks()`), gets
+    the spatial columns (see `spatial_preparation_power_plants()`) and is
+    appended to the table of the category in the hdf5 file (or to the
+    csv-file). Only one chunk is kept in memory.
+
+    Returns
+    -------
+    int : Number of stored power plants.
+
+    """
+    logging.info("Preparing {0} opsd power plants".format(category))
+    if not csv and os.path.isfile(filename):
+        with pd.HDFStore(filename, mode='a') as store:
+            if category in store:
+                store.remove(category)
+
+    number = 0
+    for df in prepare_opsd_chunks(category, overwrite, latest=latest):
+        if len(df) == 0:
+            continue
+        pp = geo.Geometry('{0} power plants'.format(category), df=df)
+        pp = spatial_preparation_power_plants(pp)
+        if csv:
+            pp.get_df().to_csv(filename, mode='w' if number == 0 else 'a',
+                               header=number == 0)
+        else:
+            tools.store_plant_table(pp.get_df(geo_as_str=False), filename,
+                                    category, append=True)
+        number += len(pp.gdf)
+
+    if not csv and number > 0:
+        tools.index_plant_table(filename, category)
+    logging.info("{0} {1} power plants stored to {2}".format(
+        number, category, filename))
+    return number
+
+
+def prepare_category_worker(category, filename, overwrite, latest, lock):
+    """Prepare a category in a separate process and store the table to its
+    own file (see `prepare_categories_concurrently()`)."""
+    global _hdf_lock
+    _hdf_lock = lock
+    prepare_category(category, filename, overwrite, latest)
+
+
+def prepare_categories_concurrently(categories, opsd_file_name, overwrite,
+                                    latest=False):
+    """Prepare each category in a separate process.
+
+    Every process writes its table to a temporary file. The shared cache files
+    are locked while they are written. The tables are copied to the output
+    store one after another when all processes have finished, so the total
+    time is the time of the slowest category.
+    """
+    lock = multiprocessing.Lock()
+    workers = {}
+    for category in categories:
+        tmp_file = '{0}.{1}.tmp'.format(opsd_file_name, category)
+        workers[category] = (tmp_file, multiprocessing.Process(
+            target=prepare_category_worker, name='opsd_{0}'.format(category),
+            args=(category, tmp_file, overwrite, latest, lock)))
+        workers[category][1].start()
+
+    failed = []
+    for category, (tmp_file, process) in workers.items():
+        process.join()
+        if process.exitcode != 0:
+            failed.append(category)
+
+    try:
+        if len(failed) > 0:
+            raise RuntimeError("Preparation of the {0} power plants "
+                               "failed.".format(', '.join(failed)))
+        for category, (tmp_file, process) in workers.items():
+            tools.copy_plant_table(tmp_file, opsd_file_name, category)
+    finally:
+        for tmp_file, process in workers.values():
+            if os.path.isfile(tmp_file):
+                os.remove(tmp_file)
+
+
+def opsd_power_plants(overwrite=False, csv=False, latest=False,
+                      concurrent=True):
     """
 
     Parameters
     ----------
     csv
     overwrite
+    latest : bool
+        Download the latest opsd release instead of the 2017 release.
+    concurrent : bool
+        Prepare the categories in separate processes (hdf5 only).
 
     Returns
     -------
 
     """
-    strcols = {
-        'conventional': [
-            'name_bnetza', 'block_bnetza', 'name_uba', 'company', 'street',
-            'postcode', 'city', 'state', 'country_code', 'fuel', 'technology',
-            'chp', 'commissioned_original', 'status', 'type', 'eic_code_plant',
-            'eic_code_block', 'efficiency_source', 'energy_source_level_1',
-            'energy_source_level_2', 'energy_source_level_3', 'eeg',
-            'network_node', 'voltage', 'network_operator', 'merge_comment',
-            'geometry', 'federal_states'],
-        'renewable': [
-            'commissioning_date', 'decommissioning_date',
-            'energy_source_level_1', 'energy_source_level_2',
-            'energy_source_level_3', 'technology', 'voltage_level', 'comment',
-            'geometry', 'federal_states']}
-
+    categories = ['conventional', 'renewable']
     if csv:
         opsd_file_name = os.path.join(
             cfg.get('paths', 'opsd'),
             cfg.get('opsd', 'opsd_prepared_csv_pattern'))
-        hdf = None
     else:
         opsd_file_name = os.path.join(
             cfg.get('paths', 'opsd'), cfg.get('opsd', 'opsd_prepared'))
-        if os.path.isfile(opsd_file_name) and not overwrite:
-            hdf = None
-        else:
-            if os.path.isfile(opsd_file_name):
-                os.remove(opsd_file_name)
-            hdf = pd.HDFStore(opsd_file_name, mode='a')
+        exist = os.path.isfile(opsd_file_name) and not overwrite
+        if not exist and os.path.isfile(opsd_file_name):
+            os.remove(opsd_file_name)
+        if not exist and concurrent:
+            prepare_categories_concurrently(categories, opsd_file_name,
+                                            overwrite, latest)
+            logging.info("Opsd power plants stored to {0}".format(
+                opsd_file_name))
+            exist = True
 
     # If the power plant file does not exist, download and prepare it.
-    for category in ['conventional', 'renewable']:
+    for category in categories:
         # Define file and path pattern for power plant file.
         cleaned_file_name = os.path.join(
             cfg.get('paths', 'opsd'),
@@ -408,30 +823,136 @@ def opsd_power_plants(overwrite=False, csv=False):
                 cat=category))
         if csv:
             exist = os.path.isfile(opsd_file_name) and not overwrite
-        else:
-            exist = hdf is None
 
         if not exist:
-            logging.info("Preparing {0} opsd power plants".format(category))
-            df = load_opsd_file(category, overwrite, prepared=True)
-            pp = geo.Geometry('{0} power plants'.format(category), df=df)
-            pp = spatial_preparation_power_plants(pp)
-            if csv:
-                pp.get_df().to_csv(opsd_file_name)
-            else:
-                df = pp.get_df()
-                df[strcols[category]] = df[strcols[category]].astype(str)
-                hdf[category] = df
-            logging.info("Opsd power plants stored to {0}".format(
-                opsd_file_name))
+            prepare_category(category, opsd_file_name, overwrite, latest,
+                             csv=csv)
 
         if os.path.isfile(cleaned_file_name):
             os.remove(cleaned_file_name)
-    if hdf is not None:
-        hdf.close()
     return opsd_file_name
 
 
+def update_possible_opsd():
+    """Check if the prepared opsd tables and the row hashes of both categories
+    exist, so that a new release can be added incrementally."""
+    opsd_file_name = os.path.join(
+        cfg.get('paths', 'opsd'), cfg.get('opsd', 'opsd_prepared'))
+    if not os.path.isfile(opsd_file_name):
+        return False
+    for category in ['conventional', 'renewable']:
+        if load_row_hashes_opsd(category) is None:
+            return False
+        try:
+            if not tools.is_plant_table(opsd_file_name, category):
+                return False
+        except KeyError:
+            return False
+    return True
+
+
+def update_opsd_table(category, latest=True):
+    """Update the prepared opsd table of a category with a new release.
+
+    The new original file is compared with the row hashes of the last
+    prepared release by plant id and row hash. Only added or changed plants
+    are completed and spatially prepared, removed plants are dropped and
+    unchanged plants are taken from the prepared table.
+
+    Parameters
+    ----------
+    category : str
+        'conventional' or 'renewable'
+    latest : bool
+        Download the latest release (True) or the 2017 release (False).
+
+    Returns
+    -------
+    pandas.DataFrame : The capacity of the added, removed and changed plants
+        by energy_source_level_2 in MW.
+
+    """
+    opsd_file_name = os.path.join(
+        cfg.get('paths', 'opsd'), cfg.get('opsd', 'opsd_prepared'))
+    remove_list, date_cols, month = prepare_settings_opsd(category)
+
+    old_hashes = load_row_hashes_opsd(category)
+    df = load_original_opsd_file(category, True, latest=latest)
+    new_hashes = row_hashes_opsd(df, category)
+
+    # Compare the rows by their key (plant id) and their hash.
+    old_keys = row_keys_opsd(old_hashes)
+    new_keys = row_keys_opsd(new_hashes)
+    old_label = pd.Series(old_hashes.index, index=old_keys)
+    old_hash = pd.Series(old_hashes['hash'].values, index=old_keys)
+    known = pd.Series(new_keys).isin(old_label.index).values
+    same = known & (
+        pd.Series(new_keys).map(old_hash).values == new_hashes['hash'].values)
+    added = ~known
+    changed = known & ~same
+    removed = ~pd.Series(old_keys).isin(new_keys).values
+
+    # Use the labels of the prepared table for known plants. New renewable
+    # plants are numbered after the highest existing label.
+    if cfg.get('opsd', '{0}_id'.format(category)) != 'index':
+        labels = pd.Series(new_keys).map(old_label)
+        start = old_hashes.index.max() + 1 if len(old_hashes) > 0 else 0
+        labels[added] = np.arange(start, start + added.sum())
+        df.index = labels.astype(np.int64).values
+        new_hashes.index = df.index
+
+    logging.info("Opsd {0}: {1} added, {2} changed, {3} removed, {4} "
+                 "unchanged plants.".format(category, added.sum(),
+                                            changed.sum(), removed.sum(),
+                                            same.sum()))
+
+    old_pp = tools.read_plant_table(opsd_file_name, category,
+                                    geometry='shapely', categorical=False)
+    drop = old_hashes.index[removed].union(df.index[changed])
+    dropped = old_pp.loc[old_pp.index.isin(drop)]
+    old_pp = old_pp.loc[~old_pp.index.isin(drop)]
+
+    tables = [old_pp]
+    new_pp = None
+    if (added | changed).any():
+        report = geometry_report_opsd(category, fs_column='state',
+                                      keep_cache=True)
+        new_df = prepare_opsd_chunk(df.loc[added | changed], report,
+                                    remove_list, date_cols, month)
+        if report['chunks'] > 0:
+            write_geometry_report_opsd(report)
+        pp = geo.Geometry('{0} power plants'.format(category), df=new_df)
+        pp = spatial_preparation_power_plants(pp)
+        new_pp = pp.get_df(geo_as_str=False)
+        tables.append(new_pp)
+
+    tools.store_plant_table(pd.concat(tables).sort_index(), opsd_file_name,
+                            category)
+    store_row_hashes_opsd(category, new_hashes)
+    logging.info("Opsd power plants updated in {0}".format(opsd_file_name))
+
+    # Capacity deltas by energy source
+    src = 'energy_source_level_2'
+    deltas = pd.DataFrame()
+    if new_pp is not None:
+        deltas['added'] = new_pp.loc[new_pp.index.isin(
+            df.index[added])].groupby(src)['capacity'].sum()
+        deltas['changed_new'] = new_pp.loc[new_pp.index.isin(
+            df.index[changed])].groupby(src)['capacity'].sum()
+    deltas = deltas.reindex(columns=['added', 'changed_new'])
+    deltas = deltas.join(dropped.loc[dropped.index.isin(df.index[changed])]
+                         .groupby(src)['capacity'].sum()
+                         .rename('changed_old'), how='outer')
+    deltas = deltas.join(dropped.loc[~dropped.index.isin(df.index[changed])]
+                         .groupby(src)['capacity'].sum().rename('removed'),
+                         how='outer')
+    deltas = deltas.fillna(0)
+    deltas['delta'] = (deltas['added'] - deltas['removed'] +
+                       deltas['changed_new'] - deltas['changed_old'])
+    deltas.index.name = src
+    return deltas
+
+
 def spatial_preparation_power_plants(pp):
     """Add spatial names to DataFrame. Three columns will be added to the
     power plant table:
@@ -458,25 +979,22 @@ def spatial_preparation_power_plants(pp):
     logging.info("Remove invalid geometries")
     pp.remove_invalid_geometries()
 
-    # Add column with name of the federal state (Bayern, Berlin,...)
-    federal_states = geo.Geometry('federal states')
-    federal_states.load(cfg.get('paths', 'geometry'),
-                        cfg.get('geometry', 'federalstates_polygon'))
-    pp.gdf = geo.spatial_join_with_buffer(pp, federal_states)
+    # Add column with name of the federal state (Bayern, Berlin,...). The
+    # number of join processes is limited, because the categories may be
+    # prepared in parallel (see `prepare_categories_concurrently()`).
+    federal_states = geo.registry.get('federal_states')
+    pp.gdf = geo.spatial_join_in_chunks(
+        pp, federal_states, processes=cfg.get('opsd', 'join_processes'))
 
     # Add country code to federal state if country code is not 'DE'.
     if 'country_code' in pp.gdf.columns:
-        country_codes = list(pp.gdf.country_code.unique())
-        country_codes.remove('DE')
+        country_codes = set(pp.gdf.country_code.dropna().unique()) - {'DE'}
         for c_code in country_codes:
             pp.gdf.loc[pp.gdf.country_code == c_code, 'federal_states'] = (
                 c_code)
 
     # Add column with coastdat id
-    coastdat = geo.Geometry('coastdat2')
-    coastdat.load(cfg.get('paths', 'geometry'),
-                  cfg.get('coastdat', 'coastdatgrid_polygon'))
-    pp.gdf = geo.spatial_join_with_buffer(pp, coastdat)
+    pp.gdf = geo.spatial_join_with_grid(pp, 'coastdat2')
 
     return pp
 
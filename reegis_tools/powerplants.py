@@ -13,6 +13,7 @@ __license__ = "GPLv3"
 # Python libraries
 import os
 import logging
+import multiprocessing
 
 # External libraries
 import pandas as pd
@@ -25,9 +26,12 @@ import oemof.tools.logger
 import reegis_tools.config as cfg
 import reegis_tools.opsd as opsd
 import reegis_tools.geometries as geo
+import reegis_tools.tools as tools
 
 
-def patch_offshore_wind(orig_df, columns):
+def prepare_offshore_wind_patch(columns):
+    """Read the offshore wind patch and add the federal state and the
+    coastdat id of each plant (see `patch_offshore_wind()`)."""
     df = pd.DataFrame(columns=columns)
 
     offsh = pd.read_csv(
@@ -49,20 +53,23 @@ def patch_offshore_wind(orig_df, columns):
     new_col = 'federal_states'
     if new_col in goffsh.gdf:
         del goffsh.gdf[new_col]
-    federal_states = geo.Geometry(new_col)
-    federal_states.load(cfg.get('paths', 'geometry'),
-                        cfg.get('geometry', 'federalstates_polygon'))
+    federal_states = geo.registry.get(new_col)
     goffsh.gdf = geo.spatial_join_with_buffer(goffsh, federal_states)
 
     # Add column with coastdat id
     new_col = 'coastdat2'
     if new_col in goffsh.gdf:
         del goffsh.gdf[new_col]
-    coastdat = geo.Geometry(new_col)
-    coastdat.load(cfg.get('paths', 'geometry'),
-                  cfg.get('coastdat', 'coastdatgrid_polygon'))
-    goffsh.gdf = geo.spatial_join_with_buffer(goffsh, coastdat)
-    offsh_df = goffsh.get_df()
+    goffsh.gdf = geo.spatial_join_with_grid(goffsh, new_col)
+    return goffsh.get_df()
+
+
+def patch_offshore_wind(orig_df, columns, offsh_df=None):
+    """Replace the offshore wind plants of the table with the plants of the
+    offshore wind patch. A prepared patch (see
+    `prepare_offshore_wind_patch()`) can be passed."""
+    if offsh_df is None:
+        offsh_df = prepare_offshore_wind_patch(columns)
 
     new_cap = offsh_df['capacity'].sum()
     old_cap = orig_df.loc[orig_df['technology'] == 'Offshore',
@@ -84,6 +91,13 @@ def pp_opsd2reegis(offshore_patch=True):
     Adapt opsd power plants to a more generalised reegis API with a reduced
     number of columns
 
+    The table is stored as a typed, queryable table (see
+    `tools.store_plant_table()`). Besides the kept opsd columns it has a
+    'category' column with the opsd category of each plant ('renewable' or
+    'conventional'), so both categories can be queried separately (see
+    `tools.plant_query()`). The plants keep their coordinates in the 'lon'
+    and 'lat' columns (see `tools.plant_coordinates()`).
+
     Parameters
     ----------
     offshore_patch : bool
@@ -105,41 +119,60 @@ def pp_opsd2reegis(offshore_patch=True):
                  'geometry', 'energy_source_level_2', 'capacity', 'technology',
                  'federal_states', 'com_year', 'coastdat2', 'efficiency'}
 
-    string_cols = ['chp', 'comment', 'energy_source_level_1',
-                   'energy_source_level_2', 'energy_source_level_3',
-                   'federal_states', 'geometry', 'technology']
-
     # Create opsd power plant tables if they do not exist.
-    if not os.path.isfile(filename_in):
+    complete = os.path.isfile(filename_in)
+    if not complete:
         msg = "File '{0}' does not exist. Will create it from source files."
         logging.debug(msg.format(filename_in))
-        filename_in = opsd.opsd_power_plants()
     else:
-        complete = True
         for cat in ['renewable', 'conventional']:
             try:
-                pd.read_hdf(filename_in, cat, mode='r')
+                if not tools.is_plant_table(filename_in, cat):
+                    msg = "Key '{1}' of file '{0}' is stored in an old format."
+                    logging.warning(msg.format(filename_in, cat))
+                    complete = False
             except KeyError:
                 msg = "File '{0}' exists but key '{1}' is not present."
                 logging.debug(msg.format(filename_in, cat))
                 complete = False
         if not complete:
             logging.debug("Will re-create file with all keys.")
-            filename_in = opsd.opsd_power_plants(overwrite=True)
+
+    offsh_df = None
+    if not complete:
+        # The offshore patch is prepared in a separate process while the
+        # opsd categories are prepared.
+        pool = None
+        try:
+            if offshore_patch:
+                pool = multiprocessing.Pool(1)
+                offsh_job = pool.apply_async(prepare_offshore_wind_patch,
+                                             (keep_cols,))
+            filename_in = opsd.opsd_power_plants(
+                overwrite=os.path.isfile(filename_in))
+            if pool is not None:
+                pool.close()
+                offsh_df = offsh_job.get()
+                pool.join()
+        finally:
+            if pool is not None:
+                pool.terminate()
     #
     pp = {}
     for cat in ['renewable', 'conventional']:
-        # Read opsd power plant tables
-        pp[cat] = pd.read_hdf(filename_in, cat, mode='r')
+        # Read the needed columns of the opsd power plant tables
+        columns = [c for c in tools.plant_table_columns(filename_in, cat)
+                   if c in keep_cols]
+        pp[cat] = tools.read_plant_table(filename_in, cat, columns=columns,
+                                         categorical=False)
 
         # Patch offshore wind energy with investigated data.
         if cat == 'renewable' and offshore_patch:
-            pp[cat] = patch_offshore_wind(pp[cat], keep_cols)
+            pp[cat] = patch_offshore_wind(pp[cat], keep_cols, offsh_df)
 
         pp[cat] = pp[cat].drop(columns=set(pp[cat].columns) - keep_cols)
-
-        # Replace 'nan' strings with nan values.
-        pp[cat] = pp[cat].replace('nan', np.nan)
+        # The opsd category is stored as a queryable column.
+        pp[cat]['category'] = cat
 
         # Remove lines with comments. Comments mark suspicious data.
         pp[cat] = pp[cat].loc[pp[cat].comment.isnull()]
@@ -165,39 +198,453 @@ def pp_opsd2reegis(offshore_patch=True):
     del pp['chp_capacity_uba']
 
     # Remove storages (Speicher) from power plant table
-    pp = pp.loc[pp['energy_source_level_2'] != 'Speicher']
+    pp = pp.loc[pp['energy_source_level_2'] != 'Speicher'].copy()
 
-    # Convert all values to strings in string-columns
-    pp[string_cols] = pp[string_cols].astype(str)
+    # Store the coordinates as well, so compact tables can be read without
+    # decoding the geometries.
+    tools.plant_coordinates(pp)
 
     # Store power plant table to hdf5 file.
-    pp.to_hdf(filename_out, 'pp', mode='w')
+    tools.store_plant_table(pp, filename_out, 'pp', mode='w')
+    store_capacity_cube(pp, filename_out)
 
     logging.info("Reegis power plants based on opsd stored in {0}".format(
         filename_out))
     return filename_out
 
 
+def update_power_plants(latest=True, offshore_patch=True):
+    """Update the opsd and the reegis power plant tables with a new opsd
+    release.
+
+    Only added or changed plants are prepared (see
+    `opsd.update_opsd_table()`). If no prepared tables or row hashes exist,
+    all tables are created from scratch. The capacity changes by category and
+    energy_source_level_2 are stored in the messages directory.
+
+    Parameters
+    ----------
+    latest : bool
+        Use the latest opsd release (True) or the 2017 release (False).
+    offshore_patch : bool
+        See `pp_opsd2reegis()`.
+
+    Returns
+    -------
+    pandas.DataFrame : Capacity changes in MW or None if the tables were
+        created from scratch.
+    """
+    if not opsd.update_possible_opsd():
+        logging.warning("No prepared opsd tables to update. All tables will "
+                        "be created from scratch.")
+        opsd.opsd_power_plants(overwrite=True, latest=latest)
+        pp_opsd2reegis(offshore_patch=offshore_patch)
+        return None
+
+    deltas = pd.concat(
+        {cat: opsd.update_opsd_table(cat, latest=latest)
+         for cat in ['conventional', 'renewable']},
+        names=['category'])
+    pp_opsd2reegis(offshore_patch=offshore_patch)
+
+    deltas.to_csv(os.path.join(cfg.get('paths', 'messages'),
+                               'opsd_update_report.csv'))
+    total = deltas.sum()
+    logging.info("Capacity changes (MW): {0:.0f} added, {1:.0f} removed, "
+                 "{2:.0f} changed, {3:.0f} net.".format(
+                     total['added'], total['removed'],
+                     total['changed_new'] - total['changed_old'],
+                     total['delta']))
+    return deltas
+
+
+def add_model_regions(pp, regions, name=None):
+    """Add a column with the region of each power plant.
+
+    The regions are taken from the region mapping of the region set, so the
+    spatial join is only done for new or moved power plants. Power plants
+    without a geometry are marked as 'unknown'.
+
+    Parameters
+    ----------
+    pp : pandas.DataFrame
+        Power plant table with a geometry column (WKT).
+    regions : reegis_tools.geometries.Geometry
+        Region polygons.
+    name : str
+        Name of the new column. Default: name of the Geometry object.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    if name is None:
+        name = '_'.join(regions.name.split())
+    located = pp['geometry'].notnull()
+    plants = geo.Geometry(name='power plants',
+                          df=pp.loc[located, ['geometry']].copy())
+    plants.create_geo_df()
+    pp[name] = geo.region_mapping(regions).assign('plant', plants)
+    pp[name] = pp[name].fillna('unknown')
+    return pp
+
+
+def capacity_matrix(pp, years, column='capacity', monthly=False):
+    """Effective capacity of each plant in each year (or month) in one
+    vectorised pass.
+
+    The annual values are the same as the 'capacity_<year>' columns of
+    `get_pp_by_year()`: the full capacity between the commissioning and the
+    decommissioning year, the remaining months in the commissioning year and
+    com_month/12 in the decommissioning year. Inactive plants are NaN.
+
+    With monthly=True each month of the given years is a column. A plant is
+    active in the months after com_month of the commissioning year up to
+    decom_month of the decommissioning year.
+
+    Parameters
+    ----------
+    pp : pandas.DataFrame
+        Power plant table with the columns com_year, com_month, decom_year,
+        decom_month and the capacity column.
+    years : iterable of int
+    column : str
+        Name of the capacity column.
+    monthly : bool
+
+    Returns
+    -------
+    pandas.DataFrame : Plants (rows) and years or months (columns).
+    """
+    years = np.asarray(list(years))
+    capacity = pp[column].values.astype(float)[:, np.newaxis]
+    com_year = pp['com_year'].values.astype(float)[:, np.newaxis]
+    decom_year = pp['decom_year'].values.astype(float)[:, np.newaxis]
+    com_month = pp['com_month'].values.astype(float)[:, np.newaxis]
+
+    if monthly:
+        columns = pd.date_range('{0}-01-01'.format(years.min()),
+                                '{0}-12-01'.format(years.max()), freq='MS')
+        columns = columns[columns.year.isin(years)]
+        month = (columns.year.values * 12 + columns.month.values - 1)
+        first = com_year * 12 + com_month - 1
+        decom_month = pp['decom_month'].values.astype(float)[:, np.newaxis]
+        last = decom_year * 12 + decom_month - 1
+        matrix = np.where((first < month) & (month <= last), capacity, np.nan)
+        return pd.DataFrame(matrix, index=pp.index, columns=columns)
+
+    matrix = np.where((com_year < years) & (decom_year > years), capacity,
+                      np.nan)
+    matrix = np.where(com_year == years, capacity * (12 - com_month) / 12,
+                      matrix)
+    matrix = np.where(decom_year == years, capacity * com_month / 12, matrix)
+    return pd.DataFrame(matrix, index=pp.index, columns=years)
+
+
+def get_capacity_matrix(years=None, column='capacity', monthly=False,
+                        overwrite=False):
+    """Annual (or monthly) capacity matrix of the reegis power plants (see
+    `capacity_matrix()`).
+
+    The matrix is cached next to the power plant table in reegis_pp.h5 with
+    one node for each year, so a year or a range of years is read as a
+    slice of columns. Years that are not cached yet are calculated in one
+    pass and added to the cache if they are within the years defined in the
+    config file ([powerplants] capacity_first_year/capacity_last_year). The
+    cache is removed when the power plant table is re-created.
+
+    Parameters
+    ----------
+    years : iterable of int
+        Default: all years of the config file.
+    column : str
+        Name of the capacity column.
+    monthly : bool
+        Return one column for each month of the years.
+    overwrite : bool
+        Recalculate the cached years.
+
+    Returns
+    -------
+    pandas.DataFrame : Plants (rows, index of the reegis table) and years or
+        months (columns).
+    """
+    filename = os.path.join(cfg.get('paths', 'powerplants'),
+                            cfg.get('powerplants', 'reegis_pp'))
+    if not os.path.isfile(filename):
+        msg = "File '{0}' does not exist. Will create it from reegis file."
+        logging.debug(msg.format(filename))
+        filename = pp_opsd2reegis()
+    key = 'capacity_matrix_{0}'.format(column)
+    if monthly:
+        key += '_monthly'
+    cached = range(cfg.get('powerplants', 'capacity_first_year'),
+                   cfg.get('powerplants', 'capacity_last_year') + 1)
+    if years is None:
+        years = cached
+    years = list(years)
+    nodes = {y: '/{0}/y{1}'.format(key, y) for y in years}
+
+    parts = {}
+    if not overwrite:
+        with pd.HDFStore(filename, mode='r') as store:
+            keys = set(store.keys())
+            for year, node in nodes.items():
+                if node in keys:
+                    parts[year] = store[node]
+
+    missing = [y for y in years if y not in parts]
+    if len(missing) > 0:
+        pp = tools.read_plant_table(filename, 'pp', categorical=False)
+        matrix = capacity_matrix(pp, missing, column, monthly=monthly)
+        with pd.HDFStore(filename, mode='a') as store:
+            for year in missing:
+                if monthly:
+                    parts[year] = matrix.loc[:, matrix.columns.year == year]
+                else:
+                    parts[year] = matrix[year]
+                if year in cached:
+                    store.put(nodes[year], parts[year])
+        logging.info("Capacity matrix of {0} years calculated.".format(
+            len(missing)))
+
+    if monthly:
+        return pd.concat([parts[y] for y in years], axis=1)
+    return pd.concat({y: parts[y] for y in years}, axis=1)
+
+
+def capacity_cube(pp, years):
+    """Capacity of each year summed by energy source, federal state and
+    coastdat id (see `capacity_matrix()`).
+
+    Missing energy sources and federal states are named 'unknown', plants
+    without coastdat id get the id -1. Inactive plants count as 0.
+
+    Parameters
+    ----------
+    pp : pandas.DataFrame
+        Reegis power plant table.
+    years : iterable of int
+
+    Returns
+    -------
+    pandas.DataFrame : (energy_source_level_2, federal_states, coastdat2)
+        MultiIndex and one column for each year.
+    """
+    keys = [pp['energy_source_level_2'].astype(object).fillna('unknown'),
+            pp['federal_states'].astype(object).fillna('unknown'),
+            pd.to_numeric(pp['coastdat2'], errors='coerce').fillna(-1).astype(
+                np.int64)]
+    return capacity_matrix(pp, years).groupby(keys, observed=True).sum()
+
+
+def store_capacity_cube(pp, filename):
+    """Store the capacity cube of the years defined in the config file
+    ([powerplants] capacity_first_year/capacity_last_year) next to the
+    power plant table."""
+    years = range(cfg.get('powerplants', 'capacity_first_year'),
+                  cfg.get('powerplants', 'capacity_last_year') + 1)
+    cube = capacity_cube(pp, years)
+    cube.to_hdf(filename, 'capacity_cube', mode='a', format='table')
+    logging.info("Capacity cube {0}-{1} ({2} rows) stored to {3}.".format(
+        years[0], years[-1], len(cube), filename))
+    return cube
+
+
+def get_capacity_cube(years=None, energy_source=None, state=None,
+                      coastdat_id=None, groupby=None):
+    """Installed capacity from the stored capacity cube (see
+    `capacity_cube()`) without loading the plant table.
+
+    Years outside the stored range are calculated from the power plant
+    table.
+
+    Parameters
+    ----------
+    years : int or iterable of int
+        A single year returns a Series named 'capacity_<year>'. Default: all
+        stored years.
+    energy_source : str or list
+        Values of energy_source_level_2.
+    state : str or list
+        Values of federal_states.
+    coastdat_id : int or list
+    groupby : list
+        Levels of the result. The capacity is summed over all other levels.
+        Default: ['energy_source_level_2', 'federal_states', 'coastdat2'].
+
+    Returns
+    -------
+    pandas.DataFrame or pandas.Series
+
+    Examples
+    --------
+    Capacity with the (category, region, coastdat_id) index used by
+    `coastdat.aggregate_by_region_coastdat_feedin()`:
+
+    >>> pp = get_capacity_cube(2014).to_frame()  # doctest: +SKIP
+    """
+    filename = os.path.join(cfg.get('paths', 'powerplants'),
+                            cfg.get('powerplants', 'reegis_pp'))
+    if not os.path.isfile(filename):
+        filename = pp_opsd2reegis()
+
+    single = isinstance(years, (int, np.integer))
+    if single:
+        years = [years]
+    elif years is not None:
+        years = list(years)
+
+    stored = range(cfg.get('powerplants', 'capacity_first_year'),
+                   cfg.get('powerplants', 'capacity_last_year') + 1)
+    where = tools.plant_query(energy_source=energy_source, state=state)
+
+    if years is not None and not set(years).issubset(stored):
+        logging.debug("Years outside {0}-{1} are calculated.".format(
+            stored[0], stored[-1]))
+        pp = tools.read_plant_table(filename, 'pp', categorical=False,
+                                    energy_source=energy_source, state=state)
+        cube = capacity_cube(pp, years)
+    else:
+        try:
+            tools.plant_table_columns(filename, 'capacity_cube')
+        except KeyError:
+            store_capacity_cube(tools.read_plant_table(
+                filename, 'pp', categorical=False), filename)
+        cube = pd.read_hdf(filename, 'capacity_cube', mode='r',
+                           where=where or None, columns=years)
+
+    if coastdat_id is not None:
+        if isinstance(coastdat_id, (int, np.integer)):
+            coastdat_id = [coastdat_id]
+        cube = cube.loc[cube.index.get_level_values('coastdat2').isin(
+            coastdat_id)]
+
+    if groupby is not None:
+        cube = cube.groupby(level=list(groupby)).sum()
+
+    if single:
+        cube = cube[years[0]].rename('capacity_{0}'.format(years[0]))
+    return cube
+
+
+def capacity_profiles(pp, index, column='capacity',
+                      groupby=('federal_states', 'energy_source_level_2')):
+    """Installed capacity of each group (e.g. region and energy source) for
+    each time step of the index.
+
+    The profiles are built from the cumulative commissioning and
+    decommissioning events of the plants. A plant counts from the first day
+    of the month after com_month up to the last day of decom_month (same as
+    the monthly `capacity_matrix()`). Missing group values are named
+    'unknown'.
+
+    Parameters
+    ----------
+    pp : pandas.DataFrame
+        Power plant table with the columns com_year, com_month, decom_year,
+        decom_month, the capacity column and the groupby columns.
+    index : pandas.DatetimeIndex
+        Time steps, e.g. the index of a feed-in time series.
+    column : str
+        Name of the capacity column.
+    groupby : iterable
+        Columns of the groups.
+
+    Returns
+    -------
+    pandas.DataFrame : Time steps (rows) and groups (columns). Without any
+        active plant the table has no columns.
+    """
+    groupby = list(groupby)
+    pp = pp.loc[pp[['com_year', 'com_month', 'decom_year', 'decom_month',
+                    column]].notnull().all(axis=1)]
+    if len(pp) == 0:
+        return pd.DataFrame(
+            index=index, dtype=float, columns=pd.MultiIndex.from_arrays(
+                [[] for _ in groupby], names=groupby))
+
+    # Month number of the commissioning and the decommissioning events
+    com = (pp['com_year'].values.astype(np.int64) * 12 +
+           pp['com_month'].values.astype(np.int64))
+    decom = (pp['decom_year'].values.astype(np.int64) * 12 +
+             pp['decom_month'].values.astype(np.int64))
+    # Plants decommissioned before their commissioning are never active.
+    pp = pp.loc[com < decom]
+    com, decom = com[com < decom], decom[com < decom]
+
+    month = index.year.values.astype(np.int64) * 12 + index.month.values - 1
+    first = month.min()
+    number = month.max() - first + 2
+
+    codes, groups = pd.MultiIndex.from_arrays(
+        [pp[c].astype(object).fillna('unknown') for c in groupby],
+        names=groupby).factorize()
+
+    # Add the events to the month of the event (earlier events to the first
+    # month, later events to an unused last month) and sum them up.
+    events = np.zeros((number, len(groups)))
+    capacity = pp[column].values.astype(float)
+    np.add.at(events, (np.clip(com - first, 0, number - 1), codes), capacity)
+    np.add.at(events, (np.clip(decom - first, 0, number - 1), codes),
+              -capacity)
+    installed = np.cumsum(events, axis=0)[month - first]
+
+    return pd.DataFrame(installed, index=index,
+                        columns=pd.MultiIndex.from_tuples(groups,
+                                                          names=groupby))
+
+
+def get_capacity_profiles(years, freq='H', state=None, energy_source=None,
+                          groupby=('federal_states', 'energy_source_level_2')):
+    """Installed capacity of the reegis power plants for each time step of
+    the given years (see `capacity_profiles()`). Only the plants that are
+    active in these years are read.
+
+    Parameters
+    ----------
+    years : int or tuple
+        Year or range of years (start, end).
+    freq : str
+        Frequency of the time steps.
+    state : str or list
+        Federal states (see `query()`).
+    energy_source : str or list
+        Values of energy_source_level_2.
+    groupby : iterable
+        Columns of the groups.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    Examples
+    --------
+    Normalised feed-in with the installed capacity of each hour:
+
+    >>> cap = get_capacity_profiles((2012, 2014))  # doctest: +SKIP
+    >>> cap_wind = cap.xs('Wind', axis=1, level=1)  # doctest: +SKIP
+    """
+    if isinstance(years, (int, np.integer)):
+        years = (years, years)
+    columns = ['capacity', 'com_year', 'com_month', 'decom_year',
+               'decom_month'] + [c for c in groupby]
+    pp = query(state=state, energy_source=energy_source, year=tuple(years),
+               columns=columns, compact=True)
+    index = pd.date_range('{0}-01-01'.format(years[0]),
+                          '{0}-12-31 23:59'.format(years[1]), freq=freq)
+    return capacity_profiles(pp, index, groupby=groupby)
+
+
 def add_capacity_by_year(year, pp=None, filename=None, key='pp'):
     if pp is None:
-        pp = pd.read_hdf(filename, key, mode='r')
-    
-    filter_cap_col = 'capacity_{0}'.format(year)
-
-    # Get all powerplants for the given year.
-    c1 = (pp['com_year'] < year) & (pp['decom_year'] > year)
-    pp.loc[c1, filter_cap_col] = pp.loc[c1, 'capacity']
-
-    c2 = pp['com_year'] == year
-    pp.loc[c2, filter_cap_col] = (pp.loc[c2, 'capacity'] *
-                                  (12 - pp.loc[c2, 'com_month']) / 12)
-    c3 = pp['decom_year'] == year
-    pp.loc[c3, filter_cap_col] = (pp.loc[c3, 'capacity'] *
-                                  pp.loc[c3, 'com_month'] / 12)
+        pp = tools.read_plant_table(filename, key)
+    pp['capacity_{0}'.format(year)] = capacity_matrix(pp, [year])[year]
     return pp
 
 
-def get_pp_by_year(year, capacity_in=False, overwrite_capacity=False):
+def get_pp_by_year(year, capacity_in=False, overwrite_capacity=False,
+                   compact=False):
     """
 
     Parameters
@@ -208,6 +655,10 @@ def get_pp_by_year(year, capacity_in=False, overwrite_capacity=False):
     overwrite_capacity : bool
         By default (False) a new column "capacity_<year>" is created. If set to
         True the old capacity column will be overwritten.
+    compact : bool
+        Return a compact table with lon/lat instead of the geometry column
+        (see `tools.compact_plant_table()`). Use `tools.plant_geometries()`
+        to rebuild the geometries.
 
     Returns
     -------
@@ -220,29 +671,23 @@ def get_pp_by_year(year, capacity_in=False, overwrite_capacity=False):
         msg = "File '{0}' does not exist. Will create it from reegis file."
         logging.debug(msg.format(filename))
         filename = pp_opsd2reegis()
-    pp = pd.read_hdf(filename, 'pp', mode='r')
+    pp = tools.read_plant_table(filename, 'pp', compact=compact)
 
     filter_columns = ['capacity_{0}']
 
     if capacity_in:
         filter_columns.append('capacity_in_{0}')
 
-    # Get all powerplants for the given year.
-    # If com_month exist the power plants will be considered month-wise.
-    # Otherwise the commission/decommission within the given year is not
-    # considered.
+    # Get all powerplants for the given year (see `capacity_matrix()`). The
+    # capacity column is read from the cached matrix.
     for fcol in filter_columns:
         filter_column = fcol.format(year)
         orig_column = fcol[:-4]
-        c1 = (pp['com_year'] < year) & (pp['decom_year'] > year)
-        pp.loc[c1, filter_column] = pp.loc[c1, orig_column]
-
-        c2 = pp['com_year'] == year
-        pp.loc[c2, filter_column] = (pp.loc[c2, orig_column] *
-                                     (12 - pp.loc[c2, 'com_month']) / 12)
-        c3 = pp['decom_year'] == year
-        pp.loc[c3, filter_column] = (pp.loc[c3, orig_column] *
-                                     pp.loc[c3, 'com_month'] / 12)
+        if orig_column == 'capacity':
+            pp[filter_column] = get_capacity_matrix([year])[year]
+        else:
+            pp[filter_column] = capacity_matrix(pp, [year],
+                                                orig_column)[year]
 
         if overwrite_capacity:
             pp[orig_column] = 0
@@ -252,6 +697,61 @@ def get_pp_by_year(year, capacity_in=False, overwrite_capacity=False):
     return pp
 
 
+def query(state=None, energy_source=None, technology=None, year=None,
+          bbox=None, columns=None, geometry='wkt', compact=False):
+    """Read the matching reegis power plants without reading the whole table.
+
+    The conditions are evaluated on the indexed data columns of the stored
+    table (see [plant_store] data_columns), so only the matching rows are
+    read.
+
+    Parameters
+    ----------
+    state : str or list
+        Federal states, e.g. 'BE' or ['BE', 'BB'].
+    energy_source : str or list
+        Values of energy_source_level_2.
+    technology : str or list
+    year : int or tuple
+        Plants that are active in the year or in any year of the range
+        (start, end). For a single year the column 'capacity_<year>' is added
+        from the cached matrix (see `get_capacity_matrix()`).
+    bbox : tuple
+        Bounding box (lon_min, lat_min, lon_max, lat_max).
+    columns : list
+        Columns to read. Default: all columns.
+    geometry : str
+        See `tools.read_plant_table()`.
+    compact : bool
+        See `tools.compact_plant_table()`.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    Examples
+    --------
+    >>> pp = query(state='BE', energy_source='Solar', year=2014
+    ...            )  # doctest: +SKIP
+    """
+    filename = os.path.join(cfg.get('paths', 'powerplants'),
+                            cfg.get('powerplants', 'reegis_pp'))
+    if not os.path.isfile(filename):
+        filename = pp_opsd2reegis()
+
+    single = isinstance(year, (int, np.integer))
+    pp = tools.read_plant_table(
+        filename, 'pp', columns=columns, geometry=geometry, compact=compact,
+        state=state, energy_source=energy_source, technology=technology,
+        year=year, bbox=bbox)
+    logging.debug("{0} power plants found.".format(len(pp)))
+
+    if single:
+        pp['capacity_{0}'.format(year)] = get_capacity_matrix(
+            [year])[year].reindex(pp.index)
+    return pp
+
+
 if __name__ == "__main__":
     oemof.tools.logger.define_logging()
     print(get_pp_by_year(2014))
@@ -13,18 +13,22 @@ __license__ = "GPLv3"
 # Python libraries
 import os
 import calendar
+import timeit
+from functools import partial
 
 # External libraries
 import pandas as pd
 import geopandas as gpd
 from matplotlib import pyplot as plt
 from shapely.geometry import Point
+from shapely.wkt import loads as wkt_loads
 
 # oemof packages
 from oemof.tools import logger
 
 # internal modules
 import reegis_tools.config as cfg
+import reegis_tools.geometries as geometries
 
 
 def lat_lon2point(df):
@@ -32,6 +36,48 @@ def lat_lon2point(df):
     return Point(df['lon'], df['lat'])
 
 
+def benchmark_geometry_files(path=None, repeat=3):
+    """Compare the row-wise and the vectorised creation of geometries for all
+    geometry csv-files (WKT or lon/lat columns) in the given path.
+
+    Parameters
+    ----------
+    path : str
+        Path to the csv-files. Defaults to the geometry path of the package.
+    repeat : int
+        Number of repetitions. The fastest run is reported.
+
+    Returns
+    -------
+    pandas.DataFrame : Number of rows and time in seconds for each file.
+    """
+    if path is None:
+        path = cfg.get('paths', 'geometry')
+    results = pd.DataFrame(columns=['rows', 'row_wise', 'vectorised'])
+    for file in sorted(os.listdir(path)):
+        if file[-4:] != '.csv':
+            continue
+        df = pd.read_csv(os.path.join(path, file))
+        wkt_cols = [c for c in ['geom', 'geometry', 'centroid', 'point']
+                    if c in df]
+        if len(wkt_cols) > 0:
+            values = df[wkt_cols[0]]
+            row_wise = partial(values.apply, wkt_loads)
+            vectorised = partial(geometries.geometries_from_wkt, values)
+        elif 'lon' in df and 'lat' in df:
+            row_wise = partial(df.apply, lat_lon2point, axis=1)
+            vectorised = partial(geometries.points_from_lon_lat, df['lon'],
+                                 df['lat'])
+        else:
+            continue
+        results.loc[file] = (
+            len(df),
+            min(timeit.repeat(row_wise, number=1, repeat=repeat)),
+            min(timeit.repeat(vectorised, number=1, repeat=repeat)))
+    results['speed_up'] = results['row_wise'] / results['vectorised']
+    return results
+
+
 def geo_csv_from_shp(shapefile, outfile, id_col, tmp_file='tmp.csv'):
     tmp = gpd.read_file(shapefile)
     tmp.to_csv(tmp_file)
@@ -13,22 +13,23 @@ __license__ = "GPLv3"
 # Python libraries
 import os
 import logging
+import numbers
 
 # External libraries
+import numpy as np
+import pandas as pd
 import requests
-from shapely.wkt import loads as wkt_loads
+import tables
 
 # oemof packages
 from oemof.tools import logger
 
+import reegis_tools.config as cfg
 import reegis_tools.geometries as geometries
 
 
 def postgis2shapely(postgis):
-    geom = list()
-    for geo in postgis:
-        geom.append(wkt_loads(geo))
-    return geom
+    return list(geometries.geometries_from_wkt(postgis))
 
 
 def download_file(filename, url, overwrite=False):
@@ -61,6 +62,372 @@ def download_file(filename, url, overwrite=False):
     return r
 
 
+def store_plant_table(df, filename, key, mode='a', append=False):
+    """Store a power plant table to a typed and queryable hdf5 table.
+
+    The geometry column is stored as WKB (hex), the columns of the
+    [plant_store] categories are stored as categoricals and all other text
+    columns as strings. The [plant_store] integer_columns (numeric ids of
+    spatial joins) are stored as numbers. Missing values and 'unknown' ids
+    are stored as NaN. The [plant_store] data_columns can be used in queries
+    (see `read_plant_table()`).
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    filename : str
+    key : str
+    mode : str
+        Mode of the hdf5 file ('a': append/replace key, 'w': new file).
+    append : bool
+        Append the rows to the table, e.g. chunk by chunk. The categories of
+        later chunks are unknown, so all text columns are stored as strings
+        of up to [plant_store] string_itemsize characters (longer strings are
+        cut). `read_plant_table()` restores the categoricals. Call
+        `index_plant_table()` after the last chunk.
+    """
+    df = df.copy()
+    if 'geometry' in df:
+        missing = df['geometry'].isnull() | df['geometry'].isin(
+            ['nan', 'None'])
+        geom = df.loc[~missing, 'geometry']
+        if len(geom) > 0 and isinstance(geom.iloc[0], str):
+            geom = geometries.geometries_from_wkt(geom)
+        df['geometry'] = pd.Series(np.nan, index=df.index, dtype=object)
+        df.loc[~missing, 'geometry'] = geometries.geometries_to_wkb(
+            geom, hex=True)
+
+    # Numeric ids of the spatial joins (e.g. coastdat2) are stored as
+    # numbers, 'unknown' becomes NaN.
+    for col in cfg.get_list('plant_store', 'integer_columns'):
+        if col in df:
+            df[col] = pd.to_numeric(df[col].replace('unknown', np.nan),
+                                    errors='coerce').astype(float)
+
+    categories = cfg.get_list('plant_store', 'categories')
+    if append:
+        # A column without any value in this chunk must keep the text type
+        # of the stored table.
+        text = set(categories)
+        if os.path.isfile(filename):
+            with pd.HDFStore(filename, mode='r') as store:
+                if key in store:
+                    stored = store.select(key, start=0, stop=0).dtypes
+                    text = set(stored.index[stored == object])
+        for col in df.columns[df.isnull().all()]:
+            if col in text:
+                df[col] = df[col].astype(object)
+    for col in df.columns[(df.dtypes == object) | (df.dtypes == 'category')]:
+        df[col] = df[col].astype(object)
+        df[col] = df[col].where(df[col].isnull(), df[col].astype(str))
+        if col in categories and not append:
+            df[col] = df[col].astype('category')
+
+    data_columns = [c for c in cfg.get_list('plant_store', 'data_columns')
+                    if c in df]
+    if append:
+        itemsize = cfg.get('plant_store', 'string_itemsize')
+        strings = list(df.columns[df.dtypes == object])
+        for col in strings:
+            cut = df[col].str.len() > itemsize
+            if cut.any():
+                logging.warning("{0} values of '{1}' cut to {2} "
+                                "characters.".format(cut.sum(), col,
+                                                     itemsize))
+                df.loc[cut, col] = df.loc[cut, col].str[:itemsize]
+        df.to_hdf(filename, key, mode=mode, format='table', append=True,
+                  data_columns=data_columns, index=False,
+                  min_itemsize={col: itemsize for col in strings})
+    else:
+        df.to_hdf(filename, key, mode=mode, format='table',
+                  data_columns=data_columns, index=False)
+        index_plant_table(filename, key)
+    logging.debug("Plant table '{0}' stored to {1}.".format(key, filename))
+
+
+def index_plant_table(filename, key):
+    """Create completely sorted indexes of the data columns of a stored
+    plant table, so queries read the matching rows without scanning the
+    table."""
+    with pd.HDFStore(filename, mode='a') as store:
+        columns = [c for c in cfg.get_list('plant_store', 'data_columns')
+                   if c in store.get_storer(key).data_columns]
+        store.create_table_index(key, columns=columns, optlevel=9,
+                                 kind='full')
+
+
+def copy_plant_table(source, filename, key):
+    """Copy a stored plant table (see `store_plant_table()`) from one hdf5
+    file to another without reading it. A table with the same key is
+    replaced.
+    """
+    with tables.open_file(source, mode='r') as src, \
+            tables.open_file(filename, mode='a') as dst:
+        src.copy_node('/' + key, dst.root, recursive=True, overwrite=True,
+                      propindexes=True)
+    logging.debug("Plant table '{0}' copied to {1}.".format(key, filename))
+
+
+def plant_query(category=None, energy_source=None, state=None, year=None,
+                technology=None, bbox=None):
+    """Create the conditions to query a power plant table.
+
+    Parameters
+    ----------
+    category : str or list
+        Values of the 'category' column (renewable, conventional).
+    energy_source : str or list
+        Values of the 'energy_source_level_2' column.
+    state : str or list
+        Values of the 'federal_states' column.
+    year : int or tuple
+        Year or range of years (start, end). Power plants that are active in
+        any of these years are selected.
+    technology : str or list
+        Values of the 'technology' column.
+    bbox : tuple
+        Bounding box (lon_min, lat_min, lon_max, lat_max) of the lon/lat
+        columns.
+
+    Returns
+    -------
+    list : Conditions for the where parameter of `pandas.read_hdf`.
+    """
+    where = []
+    for column, values in [('category', category),
+                           ('energy_source_level_2', energy_source),
+                           ('federal_states', state),
+                           ('technology', technology)]:
+        if values is not None:
+            if isinstance(values, str):
+                values = [values]
+            where.append('{0} in {1}'.format(column, list(values)))
+    if year is not None:
+        if isinstance(year, numbers.Integral):
+            year = (year, year)
+        where.append('com_year <= {0}'.format(int(year[1])))
+        where.append('decom_year >= {0}'.format(int(year[0])))
+    if bbox is not None:
+        where.append('lon >= {0} & lon <= {2} & lat >= {1} & lat <= {3}'
+                     .format(*[float(b) for b in bbox]))
+    return where
+
+
+def plant_table_columns(filename, key):
+    """Columns of a stored power plant table."""
+    return list(pd.read_hdf(filename, key, mode='r', start=0, stop=0).columns)
+
+
+def is_plant_table(filename, key):
+    """Check if a stored power plant table is a queryable table. Files of
+    older versions were stored in the fixed format."""
+    with pd.HDFStore(filename, mode='r') as store:
+        if key not in store:
+            raise KeyError("No object named {0} in the file".format(key))
+        return store.get_storer(key).is_table
+
+
+def read_fixed_plant_table(filename, key, columns=None, where=None):
+    """Read a power plant table stored in the fixed format of older versions.
+
+    The whole table is read and filtered in memory. All values of these
+    tables were stored as strings, so 'nan' is replaced by NaN, numeric
+    columns are converted to numbers and the geometry (WKT) is converted to
+    WKB (hex) as in tables of `store_plant_table()`.
+    """
+    logging.warning("The power plant table '{0}' in {1} is stored in an old "
+                    "format and cannot be queried. Delete the file to "
+                    "re-create it.".format(key, filename))
+    df = pd.read_hdf(filename, key, mode='r')
+    df = df.replace({'nan': np.nan, 'None': np.nan})
+    for col in df.columns[df.dtypes == object].drop('geometry',
+                                                    errors='ignore'):
+        values = df[col].dropna().astype(str)
+        # Keep codes with leading zeros (e.g. postcodes) as strings.
+        if values.str.match(r'0\d').any():
+            continue
+        numbers = pd.to_numeric(values, errors='coerce')
+        if numbers.notnull().all():
+            df[col] = pd.to_numeric(df[col])
+    if where:
+        df = df.query(' & '.join('({0})'.format(w) for w in where))
+    if columns is not None:
+        df = df[columns].copy()
+    if 'geometry' in df:
+        located = df['geometry'].notnull()
+        geom = geometries.geometries_from_wkt(df.loc[located, 'geometry'])
+        df['geometry'] = df['geometry'].astype(object)
+        df.loc[located, 'geometry'] = geometries.geometries_to_wkb(
+            geom, hex=True)
+    return df
+
+
+def read_plant_table(filename, key, columns=None, geometry='wkt',
+                     categorical=True, compact=False, **query):
+    """Read a power plant table stored with `store_plant_table()`.
+
+    Only the selected columns and the rows of the query are read from the
+    file. Tables in the fixed format of older versions are read completely
+    and filtered in memory. The [plant_store] integer_columns are returned
+    as nullable integers (NA for unknown ids).
+
+    Parameters
+    ----------
+    filename : str
+    key : str
+    columns : list
+        Columns to read. Default: all columns.
+    geometry : str
+        Format of the geometry column: 'wkt' (str), 'wkb' (hex str) or
+        'shapely'.
+    categorical : bool
+        Set to False to convert categorical columns to object columns.
+    compact : bool
+        Return a compact table without geometry column (see
+        `compact_plant_table()`). The geometry is not decoded if the table
+        has lon/lat columns.
+    query :
+        Parameters of `plant_query()`, e.g. energy_source='Wind'.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    Examples
+    --------
+    >>> pp = read_plant_table(filename, 'pp', energy_source=['Wind', 'Solar'],
+    ...                       state='BY', year=(2012, 2014)
+    ...                       )  # doctest: +SKIP
+    """
+    where = plant_query(**query)
+    if compact:
+        categorical = True
+        if columns is None:
+            columns = plant_table_columns(filename, key)
+        if 'lon' in columns and 'lat' in columns:
+            columns = [c for c in columns if c != 'geometry']
+        geometry = 'wkb'
+    if is_plant_table(filename, key):
+        df = pd.read_hdf(filename, key, mode='r', columns=columns,
+                         where=where if len(where) > 0 else None)
+    else:
+        df = read_fixed_plant_table(filename, key, columns, where)
+    for col in cfg.get_list('plant_store', 'integer_columns'):
+        if col in df:
+            df[col] = pd.to_numeric(df[col].replace('unknown', np.nan),
+                                    errors='coerce').astype('Int64')
+    if categorical:
+        # Tables stored in chunks contain the categories as strings.
+        for col in cfg.get_list('plant_store', 'categories'):
+            if col in df and df[col].dtype == object:
+                df[col] = df[col].astype('category')
+    if compact:
+        return compact_plant_table(df)
+    if not categorical:
+        for col in df.columns[df.dtypes == 'category']:
+            df[col] = df[col].astype(object)
+    if 'geometry' in df and geometry != 'wkb':
+        located = df['geometry'].notnull()
+        geom = geometries.geometries_from_wkb(df.loc[located, 'geometry'])
+        if geometry == 'wkt':
+            geom = geometries.geometries_to_wkt(geom)
+        df['geometry'] = df['geometry'].astype(object)
+        df.loc[located, 'geometry'] = geom
+    return df
+
+
+def plant_coordinates(df):
+    """Add the lon/lat columns of a power plant table from its geometry
+    column (WKT, WKB hex or shapely points). Plants without geometry get
+    NaN."""
+    located = df['geometry'].notnull() & ~df['geometry'].isin(['nan', 'None'])
+    geom = df.loc[located, 'geometry']
+    if len(geom) > 0 and isinstance(geom.iloc[0], str):
+        if geom.iloc[0][:5].upper() == 'POINT':
+            geom = geometries.geometries_from_wkt(geom)
+        else:
+            geom = geometries.geometries_from_wkb(geom)
+    lon, lat = geometries.lon_lat_from_points(geom)
+    for col, values in [('lon', lon), ('lat', lat)]:
+        df[col] = np.nan
+        df.loc[located, col] = values
+    return df
+
+
+def compact_plant_table(df):
+    """Reduce the memory usage of a power plant table.
+
+    The geometry column is replaced by float32 lon/lat columns, the columns
+    of [plant_compact_types] get small integer types (nullable integers if
+    values are missing, 'unknown' ids count as missing) and all other text
+    columns become categoricals ('nan' placeholders become missing values).
+    Use `plant_geometries()` to rebuild the geometries if needed. The table
+    is changed in place.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    before = df.memory_usage(deep=True).sum()
+    if 'geometry' in df:
+        if 'lon' not in df or 'lat' not in df:
+            plant_coordinates(df)
+        del df['geometry']
+    for col in ['lon', 'lat']:
+        if col in df:
+            df[col] = df[col].astype(np.float32)
+
+    for col, dtype in cfg.get_dict('plant_compact_types').items():
+        if col not in df:
+            continue
+        values = df[col].astype(object).where(
+            ~df[col].astype(object).isin(['unknown', 'nan', 'None']))
+        values = pd.to_numeric(values, errors='coerce')
+        if values.notnull().all():
+            df[col] = values.astype(dtype)
+        else:
+            df[col] = values.astype(dtype.capitalize())
+
+    for col in df.columns[df.dtypes == object]:
+        df[col] = df[col].where(~df[col].isin(['nan', 'None'])).astype(
+            'category')
+
+    after = df.memory_usage(deep=True).sum()
+    logging.info("Memory usage of the plant table: {0:.1f} MB -> {1:.1f} MB "
+                 "({2} plants).".format(before / 2 ** 20, after / 2 ** 20,
+                                        len(df)))
+    return df
+
+
+def plant_geometries(df, geometry='shapely'):
+    """Geometries of a compact power plant table (see
+    `compact_plant_table()`) from its lon/lat columns.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+    geometry : str
+        'shapely' or 'wkt'.
+
+    Returns
+    -------
+    pandas.Series : Geometry of each plant, NaN if the plant has no
+        coordinates.
+    """
+    located = df['lon'].notnull() & df['lat'].notnull()
+    geom = geometries.points_from_lon_lat(df.loc[located, 'lon'],
+                                          df.loc[located, 'lat'])
+    if geometry == 'wkt':
+        geom = geometries.geometries_to_wkt(geom)
+    series = pd.Series(np.nan, index=df.index, dtype=object, name='geometry')
+    series.loc[located] = geom
+    return series
+
+
 def convert_shp2csv(infile, outfile):
     logging.info("Converting {0} to {1}.".format(infile, outfile))
     geo = geometries.Geometry()
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the spatial joins in reegis_tools.geometries.
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import box
+
+import reegis_tools.geometries as geometries
+
+
+def _squares():
+    polygons = geometries.Geometry(name='squares')
+    polygons.gdf = geometries.gpd.GeoDataFrame(
+        {'geometry': [box(x, y, x + 1, y + 1)
+                      for x in range(4) for y in range(4)]},
+        index=['s{0}'.format(n) for n in range(16)])
+    return polygons.prepare()
+
+
+def _points(number=1000):
+    rng = np.random.default_rng(0)
+    points = geometries.Geometry(name='points', df=pd.DataFrame(
+        {'lon': rng.uniform(0.01, 3.99, number),
+         'lat': rng.uniform(0.01, 3.99, number)}))
+    return points.create_geo_df()
+
+
+def _no_sjoin(*args, **kwargs):
+    raise AssertionError("The prepared polygons were not used.")
+
+
+@pytest.mark.parametrize('chunksize, processes', [(5000, None), (300, 2)])
+def test_chunked_join_uses_prepared_polygons(monkeypatch, chunksize,
+                                             processes):
+    polygons = _squares()
+    expected = geometries.spatial_join_with_buffer(_points(), polygons)
+
+    # All points are within a polygon, so the plain spatial join is only
+    # needed if the simplified polygons are lost.
+    monkeypatch.setattr(geometries.gpd, 'sjoin', _no_sjoin)
+    result = geometries.spatial_join_in_chunks(
+        _points(), polygons, chunksize=chunksize, processes=processes)
+    pd.testing.assert_series_equal(result['squares'], expected['squares'])
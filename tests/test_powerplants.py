@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the capacity profiles in reegis_tools.powerplants.
+
+SPDX-License-Identifier: GPL-3.0-or-later
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+powerplants = pytest.importorskip('reegis_tools.powerplants')
+
+
+def _plants():
+    return pd.DataFrame({
+        'capacity': [10.0, 5.0, np.nan],
+        'com_year': [2010, 2014, 2012],
+        'com_month': [6, 3, 1],
+        'decom_year': [2050, 2014, 2050],
+        'decom_month': [12, 9, 12],
+        'federal_states': ['BE', 'BY', 'BE'],
+        'energy_source_level_2': ['Wind', 'Solar', 'Wind']})
+
+
+def test_capacity_profiles():
+    index = pd.date_range('2014-01-01', '2014-12-31 23:00', freq='H')
+    profiles = powerplants.capacity_profiles(_plants(), index)
+    assert profiles.index.equals(index)
+    assert (profiles['BE', 'Wind'] == 10).all()
+    solar = profiles['BY', 'Solar']
+    assert solar['2014-03'].eq(0).all()
+    assert solar['2014-04':'2014-09'].eq(5).all()
+    assert solar['2014-10':].eq(0).all()
+
+
+@pytest.mark.parametrize('plants', [
+    _plants().iloc[:0], _plants().iloc[2:], _plants().iloc[1:2]])
+def test_capacity_profiles_without_plants(plants):
+    # No plants, plants without capacity or plants that are decommissioned
+    # before the index.
+    index = pd.date_range('2016-01-01', periods=48, freq='H')
+    profiles = powerplants.capacity_profiles(plants, index)
+    assert profiles.index.equals(index)
+    assert profiles.sum(axis=1).eq(0).all()
+    assert list(profiles.columns.names) == [
+        'federal_states', 'energy_source_level_2']